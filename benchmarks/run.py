@@ -0,0 +1,242 @@
+# coding=utf-8
+"""Benchmark the tiling pipeline on synthetic sources.
+
+Each profile (kind of source) is generated once, then each mode is run in its
+own process, so the peak RSS is the one of that export alone:
+
+	$ python benchmarks/run.py --size 8192x8192 --output results.json
+
+The time of each export is split between the stages of the pipeline (decode,
+crop, resize, encode, insert); the time spent in one stage is not counted
+again in the stage calling it. Only the main process is timed: with
+--workers, the stages run by the workers end up in "other".
+"""
+
+import argparse
+import json
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+from collections import defaultdict
+from os import devnull
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
+
+from PIL import Image, ImageDraw, ImageFile, TiffImagePlugin
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, ROOT)
+import image2mbtiles  # noqa: E402
+
+PROFILES = ["rgb", "rgba", "ycbcr", "sparse"]
+MODES = ["level", "pyramid", "stream", "lnglat", "lnglat-rotated"]
+STAGES = ["decode", "crop", "resize", "encode", "insert"]
+
+
+def generate(profile, size, coverage, filename):
+    """Generate a synthetic source: a fractal texture (so the tiles compress
+    like real imagery, not like noise or flat colours), and for "sparse" a
+    mostly transparent image with opaque blocks over `coverage` of it.
+    """
+    w, h = size
+    base = Image.effect_mandelbrot((w, h), (-2.2, -1.3, 0.8, 1.3), 64)
+    gradient = Image.linear_gradient("L").resize((w, h))
+    im = Image.merge("RGB", (base, gradient, gradient.transpose(
+        Image.FLIP_LEFT_RIGHT)))
+    if profile == "rgb":
+        im.save(filename)
+    elif profile == "ycbcr":
+        # like the scans of the README, a JPEG compressed TIFF
+        im.convert("YCbCr").save(filename, compression="jpeg")
+    elif profile == "rgba":
+        im.putalpha(gradient)
+        im.save(filename)
+    elif profile == "sparse":
+        mask = Image.new("L", (w, h), 0)
+        draw = ImageDraw.Draw(mask)
+        block = max(1, int(min(w, h) * coverage**0.5 / 2))
+        for x, y in ((w // 4, h // 4), (w * 3 // 4, h * 2 // 3)):
+            draw.rectangle((x - block // 2, y - block // 2, x + block // 2,
+                            y + block // 2),
+                           fill=255)
+        im.putalpha(mask)
+        im.save(filename)
+    else:
+        raise ValueError("Unknown profile: {}".format(profile))
+
+
+def source_filename(workdir, profile, mode):
+    if mode == "stream":
+        # only uncompressed TIFF are read by bands
+        return join(workdir, "{}-raw.tif".format(profile))
+    extension = "tif" if profile == "ycbcr" else "png"
+    return join(workdir, "{}.{}".format(profile, extension))
+
+
+class StageTimer(object):
+    """Wrap functions to add their time to a stage, minus the time of the
+    wrapped functions they call
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(float)
+        self.stack = []
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+
+        def wrapper(*args, **kwargs):
+            self.stack.append(0.)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                nested = self.stack.pop()
+                self.stages[stage] += elapsed - nested
+                if self.stack:
+                    self.stack[-1] += elapsed
+
+        setattr(owner, name, wrapper)
+
+
+def run_case(source, mode, workers, dest):
+    timer = StageTimer()
+    timer.wrap(ImageFile.ImageFile, "load", "decode")
+    # decoded by libtiff, without ImageFile.load()
+    timer.wrap(TiffImagePlugin.TiffImageFile, "load", "decode")
+    timer.wrap(Image.Image, "crop", "crop")
+    timer.wrap(Image.Image, "paste", "crop")
+    timer.wrap(Image.Image, "resize", "resize")
+    timer.wrap(Image.Image, "reduce", "resize")
+    timer.wrap(Image.Image, "transform", "resize")
+    timer.wrap(image2mbtiles.TileEncoder, "encode", "encode")
+    timer.wrap(image2mbtiles.MBTilesWriter, "add_tile", "insert")
+    timer.wrap(image2mbtiles.MBTilesWriter, "flush", "insert")
+    timer.wrap(image2mbtiles.MBTilesWriter, "close", "insert")
+
+    start = perf_counter()
+    stdout = sys.stdout
+    with open(devnull, "w") as sys.stdout:
+        if mode.startswith("lnglat"):
+            image2mbtiles.export_lnglat(
+                source,
+                dest,
+                center="2.35,48.85",
+                meterswidth=2000.,
+                rotation=20. if mode == "lnglat-rotated" else 0.,
+                tilesdir=None,
+                workers=workers)
+        else:
+            image2mbtiles.export(
+                source,
+                dest,
+                tilesdir=None,
+                pyramid=mode == "pyramid",
+                stream=mode == "stream",
+                workers=workers)
+    sys.stdout = stdout
+    seconds = perf_counter() - start
+
+    conn = sqlite3.connect(dest)
+    tiles, = conn.execute("SELECT COUNT(*) FROM tiles").fetchone()
+    conn.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if workers > 1:
+        peak += resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    stages = dict((stage, round(timer.stages[stage], 3)) for stage in STAGES)
+    stages["other"] = round(seconds - sum(timer.stages.values()), 3)
+    return {
+        "tiles": tiles,
+        "seconds": round(seconds, 3),
+        "tiles_per_second": round(tiles / seconds, 1),
+        # kilobytes on Linux
+        "peak_rss_mb": round(peak / 1024., 1),
+        "stages": stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark image2mbtiles on synthetic sources")
+    parser.add_argument(
+        "--size", default="4096x4096", help="Size of the sources (WxH)")
+    parser.add_argument(
+        "--profiles",
+        default=",".join(PROFILES),
+        help="Sources to generate, among {}".format(", ".join(PROFILES)))
+    parser.add_argument(
+        "--modes",
+        default=",".join(MODES),
+        help="Exports to run, among {}".format(", ".join(MODES)))
+    parser.add_argument(
+        "--coverage",
+        type=float,
+        default=0.05,
+        help="Opaque part of the sparse source (0-1)")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Workers of each export")
+    parser.add_argument(
+        "--output", help="JSON file of the results (default: stdout)")
+    parser.add_argument("--case", nargs=4, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # run by the main process, in a fresh process for each case
+        source, mode, workers, dest = args.case
+        print(json.dumps(run_case(source, mode, int(workers), dest)))
+        return
+
+    size = tuple(map(int, args.size.split("x")))
+    profiles = args.profiles.split(",")
+    modes = args.modes.split(",")
+    workdir = mkdtemp(prefix="image2mbtiles-bench-")
+    results = []
+    try:
+        for profile in profiles:
+            print("Generate {} {}x{}".format(profile, *size), file=sys.stderr)
+            generate(profile, size, args.coverage,
+                     source_filename(workdir, profile, None))
+            if "stream" in modes:
+                im = Image.open(source_filename(workdir, profile, None))
+                im.save(source_filename(workdir, profile, "stream"),
+                        compression="raw")
+            for mode in modes:
+                print("Run {} {}".format(profile, mode), file=sys.stderr)
+                dest = join(workdir, "{}-{}.mbtiles".format(profile, mode))
+                output = subprocess.check_output([
+                    sys.executable,
+                    abspath(__file__), "--case",
+                    source_filename(workdir, profile, mode), mode,
+                    str(args.workers), dest
+                ])
+                result = {
+                    "profile": profile,
+                    "mode": mode,
+                    "size": list(size),
+                    "workers": args.workers,
+                }
+                result.update(json.loads(output.decode().splitlines()[-1]))
+                results.append(result)
+    finally:
+        rmtree(workdir)
+
+    report = {
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
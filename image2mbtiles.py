@@ -1,13 +1,33 @@
 # coding=utf-8
 
 import argparse
+import csv
 import sys
 from PIL import Image, ImageDraw, ImageFont
-from math import log, ceil, cos, pi, tan, atan, exp, floor
+from math import log, ceil, cos, sin, pi, tan, atan, exp, floor, radians
 from io import BytesIO
-from os.path import join, dirname, exists
-from os import makedirs
+from os.path import join, exists, abspath, dirname, getsize, normpath
+from os import devnull, makedirs, read, remove, stat, sysconf
+import json
+import mmap
 import sqlite3
+import multiprocessing
+import numpy as np
+import queue
+import re
+import signal
+import threading
+import subprocess
+from shlex import quote
+from shutil import rmtree
+from tempfile import mkdtemp
+import hashlib
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager, redirect_stdout
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 MIN_LATITUDE = -90.
@@ -15,120 +35,1368 @@ MAX_LATITUDE = 90.
 MIN_LONGITUDE = -180.
 MAX_LONGITUDE = 180.
 DEBUG_TILES = False
+# print a line for each tile, instead of the progress every PROGRESS_INTERVAL
+# seconds
+VERBOSE = False
+PROGRESS_INTERVAL = 5.
+# measure the time spent in each stage of the rendering
+STAGE_TIMERS = False
 RESAMPLE = Image.BICUBIC
+# number of encoded tiles each process keeps to avoid encoding identical
+# tiles again when deduplicating
+ENCODED_CACHE_SIZE = 256
+# number of threads writing the tiles of --tilesdir, and of tiles waiting to
+# be written before the rendering blocks
+TILESDIR_THREADS = 4
+TILESDIR_PENDING = 256
+# tile formats: name -> (format in the metadata, extension in --tilesdir)
+TILE_FORMATS = OrderedDict([
+    ("png", ("png", "png")),
+    ("png8", ("png", "png")),
+    ("jpeg", ("jpg", "jpg")),
+    ("webp", ("webp", "webp")),
+    ("webp-lossless", ("webp", "webp")),
+    # jpeg for the opaque tiles, png for the others: the extension of each
+    # tile follows its data
+    ("auto", ("png", None)),
+])
+
+# state shared with the rendering processes: it is set before the pool is
+# forked, so the decoded image is inherited instead of pickled for each tile
+_render_state = {}
+
+# tile canvases and encoding buffers of each thread, reused from one tile to
+# the next
+_reusable = threading.local()
+
+# seconds spent by this process in each stage of the rendering, when
+# STAGE_TIMERS is set
+_stage_times = defaultdict(float)
+
+
+@contextmanager
+def _stage(name):
+    if not STAGE_TIMERS:
+        yield
+        return
+    start = time()
+    try:
+        yield
+    finally:
+        _stage_times[name] += time() - start
+
+
+class Progress(object):
+    """Report the progress of an export every `interval` seconds, with the
+    throughput and the ETA. With `metrics` (a filename), the same reports are
+    appended as JSON lines, with the time spent in each stage.
+    """
 
+    def __init__(self, total, metrics=None, interval=PROGRESS_INTERVAL):
+        self.total = total
+        self.done = 0
+        self.zoom = None
+        self.interval = interval
+        self.metrics = open(metrics, "a") if metrics else None
+        self.start = self.last_report = time()
+
+    def add_total(self, count):
+        """Change the number of tiles to generate, for the tiles skipped
+        (negative count) or found on the way
+        """
+        self.total += count
+
+    def update(self, zoom, count=1):
+        self.done += count
+        self.zoom = zoom
+        now = time()
+        if now - self.last_report >= self.interval:
+            self.report(now)
+
+    def report(self, now=None, event="progress"):
+        now = now or time()
+        self.last_report = now
+        elapsed = now - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - self.done) / rate if rate else None
+        print("  - {}/{} tiles\t{:.1f} tiles/s\tETA {}".format(
+            self.done, self.total, rate,
+            timedelta(seconds=int(eta)) if eta is not None else "-"))
+        if self.metrics is not None:
+            record = OrderedDict([
+                ("event", event),
+                ("time", round(now, 3)),
+                ("zoom", self.zoom),
+                ("done", self.done),
+                ("total", self.total),
+                ("elapsed", round(elapsed, 3)),
+                ("tiles_per_second", round(rate, 3)),
+                ("eta", round(eta, 3) if eta is not None else None),
+            ])
+            if STAGE_TIMERS:
+                record["stages"] = OrderedDict(
+                    (name, round(seconds, 3))
+                    for name, seconds in sorted(_stage_times.items()))
+            self.metrics.write(json.dumps(record) + "\n")
+            self.metrics.flush()
+
+    def close(self):
+        self.report(event="done")
+        if STAGE_TIMERS:
+            print("Stages: {}".format(", ".join(
+                "{} {:.1f}s".format(name, seconds)
+                for name, seconds in sorted(_stage_times.items()))))
+        if self.metrics is not None:
+            self.metrics.close()
+
+
+def _level_grid(w, h, max_zoom, zoom, tile_size):
+    """Get the number of cols and rows generated at a level (zoom 0 being the
+    full resolution). Rows are counted from the bottom of the image (TMS).
+    """
+    step = tile_size * (2**zoom)
+    y_offset = tile_size * (2**max_zoom) - h
+    cols = int(ceil(w / float(step)))
+    rows = int(ceil(max(h, y_offset) / float(step)))
+    return cols, rows
 
-def export_level(c, im, max_zoom, zoom, tile_size, counter, max_tiles,
-                 tilesdir):
-    w, h = im.size
+
+def _crop_tile(im, zoom, ix, iy, tile_size, size=None):
+    """Cut the tile ix/iy of a level out of the full resolution image, or out
+    of a reduced version of it when `size` (the full resolution size) is given
+    """
+    w, h = size or im.size
     step = tile_size * (2**zoom)
-    max_h = tile_size * (2**max_zoom)
-    y_offset = max_h - h
-    print("-> Y offset: {}".format(y_offset))
+    x = ix * step
+    y = iy * step
+
+    cx = max(0, min(w, x))
+    cy = max(0, min(h, h - y - step))
+    cx2 = max(0, min(w, x + step))
+    cy2 = max(0, min(h, h - y))
+
+    return _resize_tile(im, (cx, cy, cx2, cy2), (w, h), step, tile_size)
+
+
+def _resize_tile(im, box, size, step, tile_size):
+    """Resize the box (in full resolution pixels) of an image, or of a reduced
+    version of it, into a tile. The tiles on the edges of the image are
+    padded with transparent pixels after the resize, at the size of a tile.
+    """
+    cx, cy, cx2, cy2 = box
+    tw = int(round((cx2 - cx) * tile_size / float(step)))
+    th = int(round((cy2 - cy) * tile_size / float(step)))
+    im2 = None
+    if tw > 0 and th > 0:
+        if step == tile_size and im.size == size:
+            with _stage("crop"):
+                im2 = im.crop(box)
+        else:
+            # without copying the box out of the image first
+            rx = im.size[0] / float(size[0])
+            ry = im.size[1] / float(size[1])
+            with _stage("resize"):
+                im2 = im.resize((tw, th),
+                                RESAMPLE,
+                                box=(cx * rx, cy * ry,
+                                     min(im.size[0], cx2 * rx),
+                                     min(im.size[1], cy2 * ry)))
+        if im2.mode == "RGBX":
+            # RGB image mapped from a scratch file
+            im2 = im2.convert("RGB")
+        if (tw, th) == (tile_size, tile_size) and im2.mode in ("RGBA", "RGB"):
+            return im2
+    with _stage("crop"):
+        im3 = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+        if im2 is not None:
+            im3.paste(im2, (0, tile_size - th))
+    return im3
+
+
+def _open_reduced(source, factor, cache):
+    """Open the source reduced by at most `factor`, when the decoder can do
+    it without decoding the full resolution: JPEG draft mode (1/2 to 1/8), or
+    a reduced page of a multi-page (pyramidal) TIFF. Return None otherwise.
+
+    The reduced images are decoded once, and kept in `cache` by size.
+    """
+    if factor < 2:
+        return None
+    im = Image.open(source)
+    w, h = im.size
+    if im.format == "JPEG":
+        im.draft(im.mode, (int(ceil(w / float(factor))),
+                           int(ceil(h / float(factor)))))
+    elif im.format == "TIFF":
+        bands = im.getbands()
+        pages = []
+        for index in range(1, getattr(im, "n_frames", 1)):
+            im.seek(index)
+            pw, ph = im.size
+            # a reduced resolution copy of the image (NewSubfileType bit 0),
+            # with the same bands and aspect ratio
+            if (im.tag_v2.get(254, 0) & 1 and im.getbands() == bands
+                    and pw < w and w <= pw * factor
+                    and abs(w * ph - h * pw) <= w + h):
+                pages.append((pw, index))
+        if not pages:
+            return None
+        im.seek(min(pages)[1])
+    else:
+        return None
+    if im.size == (w, h):
+        return None
+    if im.size not in cache:
+        im.load()
+        cache[im.size] = _tile_mode(im)
+    return cache[im.size]
+
+
+def _tile_mode(im):
+    """Convert an image to the mode of its tiles (RGB, or RGBA with
+    transparency) at once, rather than each of its tiles
+    """
+    if im.mode in ("RGB", "RGBA", "RGBX"):
+        return im
+    transparent = "transparency" in im.info or any(
+        band in ("A", "a") for band in im.getbands())
+    with _stage("decode"):
+        return im.convert("RGBA" if transparent else "RGB")
+
+
+def _reusable_canvas(mode, size):
+    """Get an image reused by the next calls of this thread with the same mode
+    and size: its content is undefined, and it must be encoded before the
+    next call
+    """
+    canvases = _reusable.__dict__.setdefault("canvases", {})
+    im = canvases.get((mode, size))
+    if im is None:
+        im = canvases[(mode, size)] = Image.new(mode, size)
+    return im
+
+
+class MBTilesWriter(object):
+    """Write tiles into a new mbtiles file.
+
+    Tiles are inserted by batch, and committed every `batch_size` tiles or
+    `commit_interval` seconds. The journal stays enabled (WAL), so a killed
+    process leaves a valid mbtiles with all the committed batches. The tile
+    index is built by `close()`, once all the tiles are in.
+
+    With `dedup`, the tiles are stored using the `map` and `images` tables,
+    each distinct tile being stored once, and `tiles` is a view joining them.
+
+    With `resume`, an existing mbtiles is completed (keeping its layout):
+    its index is built first, and the tiles added replace the existing ones.
+    """
+
+    def __init__(self, dest, batch_size=1000, commit_interval=5.,
+                 dedup=False, resume=False):
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.dedup = dedup
+        self.tiles = []
+        self.images = []
+        self.tile_ids = set()
+        self.last_commit = time()
+        # used by the threads of the lazy server, one at a time
+        self.conn = sqlite3.connect(dest, check_same_thread=False)
+        c = self.conn.cursor()
+        tables = [
+            name for name, in c.execute(
+                "SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")
+        ]
+        self.resumed = resume and "tiles" in tables
+        if self.resumed:
+            self.dedup = "map" in tables
+            c.execute("PRAGMA journal_mode = WAL")
+            c.execute("PRAGMA synchronous = NORMAL")
+            self._create_indexes()
+            if self.dedup:
+                self.tile_ids = set(
+                    tile_id for tile_id, in c.execute(
+                        "SELECT tile_id FROM images"))
+            return
+
+        # small pages waste less space after the tile blobs; the page size
+        # must be set before any table is created
+        c.execute("PRAGMA page_size = 4096")
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+
+        # create database schema
+        c.execute('CREATE TABLE metadata (name text, value text)')
+        if dedup:
+            c.execute(
+                'CREATE TABLE map (zoom_level integer, tile_column integer, tile_row integer, tile_id text)'
+            )
+            c.execute('CREATE TABLE images (tile_data blob, tile_id text)')
+            c.execute(
+                'CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, '
+                'map.tile_column AS tile_column, map.tile_row AS tile_row, '
+                'images.tile_data AS tile_data FROM map '
+                'JOIN images ON images.tile_id = map.tile_id')
+        else:
+            c.execute(
+                'CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)'
+            )
+        c.execute('CREATE UNIQUE INDEX name ON metadata (name)')
+        self.conn.commit()
+
+    def add_metadata(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                          [name, value])
+
+    def check_encoder(self, encoder):
+        """Record the key of the encoder of the tiles. A resumed mbtiles must
+        have been written with the same one (ValueError otherwise), so its
+        tiles are never mixed with tiles of other settings.
+        """
+        if self.resumed:
+            metadata = dict(
+                self.conn.execute("SELECT name, value FROM metadata WHERE "
+                                  "name IN ('encoder', 'format')"))
+            if "encoder" in metadata:
+                same = metadata["encoder"] == encoder.key
+            else:
+                # written before the key was recorded
+                same = metadata.get("format", encoder.format) == encoder.format
+            if not same:
+                self.conn.close()
+                raise ValueError(
+                    "the tiles were encoded with other settings ({}), use the "
+                    "same ones or export again".format(
+                        metadata.get("encoder", metadata.get("format"))))
+        self.add_metadata("encoder", encoder.key)
+        # committed before any tile, so a resumed export is always checked
+        self.conn.commit()
+
+    def existing_tiles(self, zoom):
+        """Get the (tile_column, tile_row) of the tiles already stored at a
+        zoom level
+        """
+        self.flush()
+        table = "map" if self.dedup else "tiles"
+        return set(
+            self.conn.execute(
+                "SELECT tile_column, tile_row FROM {} WHERE zoom_level = ?".
+                format(table), [zoom]))
+
+    def add_tile(self, zoom, tile_col, tile_row, data, tile_id=None):
+        """Add a tile. When deduplicating, tiles are identified by
+        `tile_id`, or by a hash of their data if not given.
+        """
+        if self.dedup:
+            if tile_id is None:
+                tile_id = hashlib.md5(data).hexdigest()
+            if tile_id not in self.tile_ids:
+                self.tile_ids.add(tile_id)
+                self.images.append((data, tile_id))
+            self.tiles.append((zoom, tile_col, tile_row, tile_id))
+        else:
+            self.tiles.append((zoom, tile_col, tile_row, data))
+        if (len(self.tiles) >= self.batch_size
+                or time() - self.last_commit >= self.commit_interval):
+            self.flush()
+
+    def flush(self):
+        if self.dedup:
+            self.conn.executemany("INSERT INTO images VALUES (?, ?)",
+                                  self.images)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)", self.tiles)
+        else:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", self.tiles)
+        self.conn.commit()
+        self.tiles = []
+        self.images = []
+        self.last_commit = time()
+
+    def _create_indexes(self):
+        # indicies aren't necessary but for large databases with many zoom
+        # levels may increase performance
+        if self.dedup:
+            self.conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)'
+            )
+            self.conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)'
+            )
+        else:
+            self.conn.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)'
+            )
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self._create_indexes()
+        if self.resumed and self.dedup:
+            # drop the images no longer used by replaced tiles
+            self.conn.execute(
+                "DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)"
+            )
+            self.conn.commit()
+        # get back to a single file
+        self.conn.execute("PRAGMA journal_mode = DELETE")
+        self.conn.close()
+
+
+class TilesDirWriter(object):
+    """Write tiles as {z}/{x}/{y}.png files (XYZ rows), in the background.
+    Without `extension`, the extension of each file is the format of its data
+    (see _tile_format()).
+
+    The data is the one already encoded for the mbtiles. Files are written
+    by a pool of threads, so the disk latency overlaps with the rendering,
+    and each column directory is created once.
+    """
+
+    def __init__(self, tilesdir, extension="png", threads=TILESDIR_THREADS,
+                 pending=TILESDIR_PENDING):
+        self.tilesdir = tilesdir
+        self.extension = extension
+        self.directories = set()
+        self.pending = deque()
+        self.max_pending = pending
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def add_tile(self, zoom, tile_col, tile_row, data):
+        directory = join(self.tilesdir, str(zoom), str(tile_col))
+        if directory not in self.directories:
+            makedirs(directory, exist_ok=True)
+            self.directories.add(directory)
+        filename = join(directory, "{}.{}".format(
+            flip_y(tile_row, zoom), self.extension or _tile_format(data)))
+        if len(self.pending) >= self.max_pending:
+            # raise the write errors, if any
+            self.pending.popleft().result()
+        self.pending.append(
+            self.executor.submit(self._write, filename, data))
+
+    @staticmethod
+    def _write(filename, data):
+        with open(filename, "wb") as fd:
+            fd.write(data)
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+
+def _tile_format(data):
+    """Get the format of an encoded tile, as in the mbtiles metadata
+    """
+    if data.startswith(b"\xff\xd8"):
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "png"
+
+
+class TileEncoder(object):
+    """Encode the tiles in one of the TILE_FORMATS.
+
+    `quality` is used by the lossy formats (and as the compression effort of
+    the lossless WebP), `compress_level` (0-9) by the PNG ones. None keeps the
+    Pillow defaults.
+    """
+
+    def __init__(self, name="png", quality=None, compress_level=None):
+        if name not in TILE_FORMATS:
+            raise ValueError("Unknown tile format: {}".format(name))
+        self.name = name
+        self.quality = quality
+        self.compress_level = compress_level
+        self.format, self.extension = TILE_FORMATS[name]
+        # prefix of the tile ids, so tiles encoded with other settings are
+        # never mixed when resuming
+        self.key = "{}:{}:{}".format(name, quality, compress_level)
+
+    def encode(self, im):
+        name = self.name
+        if name == "auto":
+            name = "jpeg" if _is_opaque(im) else "png"
+        params = {}
+        if name in ("png", "png8"):
+            fmt = "PNG"
+            if name == "png8":
+                im = im.quantize(256, method=Image.FASTOCTREE)
+            if self.compress_level is not None:
+                params["compress_level"] = self.compress_level
+        elif name == "jpeg":
+            fmt = "JPEG"
+            im = _flatten(im)
+        else:
+            fmt = "WEBP"
+            params["lossless"] = name == "webp-lossless"
+        if fmt != "PNG" and self.quality is not None:
+            params["quality"] = self.quality
+        # the buffer of this thread is reused, keeping its allocated size
+        sio = _reusable.__dict__.get("buffer")
+        if sio is None:
+            sio = _reusable.buffer = BytesIO()
+        sio.seek(0)
+        im.save(sio, format=fmt, **params)
+        with sio.getbuffer() as view:
+            return bytes(view[:sio.tell()])
+
+
+def _add_encoder_arguments(parser, compress_default=None):
+    """Add the options of the tiles encoding to a command line parser, read
+    back by _encoder_from_args()
+    """
+    parser.add_argument(
+        "--format",
+        choices=list(TILE_FORMATS),
+        default="png",
+        help=
+        "Format of the tiles (auto: jpeg for the opaque tiles, png for the others)"
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        help="Quality of the jpeg and webp tiles (0-100)")
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        choices=range(10),
+        metavar="{0-9}",
+        default=compress_default,
+        help="Compression level of the png tiles{}".format(
+            "" if compress_default is None else
+            " (default: {})".format(compress_default)))
+
+
+def _encoder_from_args(args):
+    return TileEncoder(args.format, args.quality, args.compress_level)
+
+
+def _is_opaque(im):
+    return im.mode == "RGB" or (im.mode == "RGBA"
+                                and im.getextrema()[3][0] == 255)
+
+
+def _flatten(im):
+    """Remove the alpha channel of a tile, over a white background
+    """
+    if im.mode == "RGB":
+        return im
+    if im.mode != "RGBA":
+        im = im.convert("RGBA")
+    im2 = Image.new("RGB", im.size, (255, 255, 255))
+    im2.paste(im, mask=im)
+    return im2
+
+
+def _encode_image(im):
+    encoder = _render_state.get("encoder")
+    if encoder is None:
+        encoder = _render_state["encoder"] = TileEncoder()
+    with _stage("encode"):
+        return encoder.encode(im)
+
+
+def _encoder_key():
+    encoder = _render_state.get("encoder")
+    return encoder.key if encoder is not None else TileEncoder().key
 
+
+def _encode_uniform_tile(im):
+    """Fast path for the tiles made of a single colour: they are encoded
+    once per colour by each process. Return None if the tile is not uniform,
+    or (None, None) if it is fully transparent and empty tiles are skipped.
+    """
+    extrema = im.getextrema()
+    if im.mode == "RGBA" and extrema[3][1] == 0 and _render_state.get(
+            "skip_empty"):
+        return None, None
+    if len(im.getbands()) == 1:
+        extrema = (extrema, )
+    if any(low != high for low, high in extrema):
+        return None
+    key = "{}:{}:{}x{}:{}".format(_encoder_key(), im.mode, im.size[0],
+                                  im.size[1], [low for low, high in extrema])
+    uniform = _render_state.setdefault("uniform", {})
+    if key not in uniform:
+        tile_id = None
+        if _render_state.get("dedup"):
+            tile_id = hashlib.md5(key.encode()).hexdigest()
+        uniform[key] = tile_id, _encode_image(im)
+    return uniform[key]
+
+
+def _encode_tile(im):
+    """Encode a tile, and return its id and data. When deduplicating, the id
+    is a hash of the pixels, and the tiles recently encoded by this process
+    are not encoded again.
+    """
+    result = _encode_uniform_tile(im)
+    if result is not None:
+        return result
+    if not _render_state.get("dedup"):
+        return None, _encode_image(im)
+    tile_id = hashlib.md5("{}:{}:{}x{}:".format(
+        _encoder_key(), im.mode, *im.size).encode() + im.tobytes()).hexdigest()
+    encoded = _render_state.setdefault("encoded", OrderedDict())
+    data = encoded.get(tile_id)
+    if data is None:
+        data = encoded[tile_id] = _encode_image(im)
+        if len(encoded) > ENCODED_CACHE_SIZE:
+            encoded.popitem(last=False)
+    else:
+        encoded.move_to_end(tile_id)
+    return tile_id, data
+
+
+def _write_tile(writer, zoom, tile_col, tile_row, data, tilesdir,
+                tile_id=None):
+    if data is None:
+        # empty tile, skipped
+        return
+    with _stage("insert"):
+        writer.add_tile(zoom, tile_col, tile_row, data, tile_id)
+        if tilesdir is not None:
+            # TilesDirWriter
+            tilesdir.add_tile(zoom, tile_col, tile_row, data)
+
+
+def _imap_tiles(func, tasks, workers, **state):
+    """Yield func(task) for each task, in order. With more than one worker,
+    the tasks are spread over a pool of processes forked after the state has
+    been set, so the results (and the mbtiles) are identical to the serial
+    mode.
+    """
+    _render_state.clear()
+    _render_state.update(state)
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    chunksize = max(1, min(64, len(tasks) // (workers * 4)))
+    _render_state["func"] = func
+    pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        if STAGE_TIMERS:
+            results = _collect_stage_times(
+                pool.imap(_run_timed, tasks, chunksize))
+        else:
+            results = pool.imap(func, tasks, chunksize)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        _render_state.clear()
+
+
+def _run_timed(task):
+    """Run the function of the pool on a task, and return its result with the
+    time spent in each stage, for _collect_stage_times()
+    """
+    _stage_times.clear()
+    result = _render_state["func"](task)
+    return result, dict(_stage_times)
+
+
+def _collect_stage_times(results):
+    for result, stage_times in results:
+        for name, seconds in stage_times.items():
+            _stage_times[name] += seconds
+        yield result
+
+
+def _render_level_tile(box):
+    im2 = _resize_tile(_render_state["im"], box, _render_state["size"],
+                       _render_state["step"], _render_state["tile_size"])
+    return _encode_tile(im2)
+
+
+def export_level(writer,
+                 im,
+                 max_zoom,
+                 zoom,
+                 tile_size,
+                 progress,
+                 tilesdir,
+                 plan,
+                 workers=1,
+                 skip_empty=False,
+                 encoder=None,
+                 size=None):
+    """Generate the tiles of a level planned by plan_image(), cutting them out
+    of the full resolution image, or out of a reduced version of it if `size`
+    (the full resolution size) is given.
+    """
+    step = tile_size * (2**zoom)
     print("-> Generate zoom {} (step is {})".format(zoom, step))
-    for x in range(0, w, step):
-        ix = x // step
-        for y in range(0, y_offset, step):
-            iy = y // step
+    tasks = plan.tasks()
+    results = _imap_tiles(
+        _render_level_tile,
+        [tuple(box) for box in plan.clipped_window().tolist()],
+        workers,
+        im=im,
+        size=size or im.size,
+        step=step,
+        tile_size=tile_size,
+        dedup=writer.dedup,
+        skip_empty=skip_empty,
+        encoder=encoder)
+    for (ix, iy), (tile_id, data) in zip(tasks, results):
+        if VERBOSE:
             print("  - {}/{}\t zoom:{}\tix:{}\tiy:{}\t({}x{}) step:{}".format(
-                counter, max_tiles, zoom, ix, iy, x, y, step))
-
-            cx = max(0, min(w, x))
-            cy = max(0, min(h, max_h - y_offset - y - step))
-            cx2 = max(0, min(w, x + step))
-            cy2 = max(0, min(h, max_h - y_offset - y))
-
-            im2 = im.crop((cx, cy, cx2, cy2))
-            dw, dh = im2.size
-            if dw < step or dh < step or cy < 0 or cy2 < 0:
-                im3 = Image.new("RGBA", (step, step), (0, 0, 0, 0))
-                im3.paste(im2, (0, step - dh, dw, step))
-                im2 = im3
-            elif im.mode not in ("RGBA", "RGB"):
-                im3 = Image.new("RGBA", (step, step), (0, 0, 0, 0))
-                im3.paste(im2, (0, 0, step, step))
-                im2 = im3
-            im2 = im2.resize((tile_size, tile_size), RESAMPLE)
-            #im2.save("output_{}_{}_{}.png".format(max_zoom - zoom, ix, iy))
-            sio = BytesIO()
-            im2.save(sio, format="PNG")
-            c.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)",
-                      [max_zoom - zoom, ix, iy, sio.getvalue()])
-            counter += 1
-
-            if tilesdir is not None:
-                current_zoom = max_zoom - zoom
-                filename = join(tilesdir,
-                                str(current_zoom),
-                                str(ix),
-                                "{}.png".format(flip_y(iy, current_zoom)))
-                directory = dirname(filename)
-                if not exists(directory):
-                    makedirs(directory)
-                im2.save(filename, format="PNG")
-
-    return counter
-
-
-def _estimate_tiles(w, h, max_zoom, tile_size):
-    count = 0
-    for zoom in range(max_zoom + 1):
-        step = tile_size * (2**zoom)
-        count += (w // step) * (h // step)
-    return count
+                progress.done + 1, progress.total, zoom, ix, iy, ix * step,
+                iy * step, step))
+        _write_tile(writer, max_zoom - zoom, ix, iy, data, tilesdir, tile_id)
+        progress.update(max_zoom - zoom)
 
 
-def export(source, dest, tilesdir, tile_size=256):
-    print("Analyse: {}".format(source))
+def _merge_tiles(children, tile_size):
+    """Build a tile from its 2x2 children of the level below, given as
+    (bottom-left, bottom-right, top-left, top-right). Missing children are
+    left transparent.
+    """
+    present = [tile for tile in children if tile is not None]
+    if len(present) == 4 and all(tile.mode == "RGB" for tile in present):
+        mode = "RGB"
+    else:
+        mode = "RGBA"
+    im = Image.new(mode, (tile_size * 2, tile_size * 2))
+    positions = ((0, tile_size), (tile_size, tile_size), (0, 0), (tile_size, 0))
+    for tile, position in zip(children, positions):
+        if tile is not None:
+            im.paste(tile, position)
+    with _stage("resize"):
+        return im.resize((tile_size, tile_size), RESAMPLE)
+
+
+def _merge_rows(bottom, top, cols, tile_size):
+    """Build a row of tiles from the two rows of the level below
+    """
+    row = []
+    for ix in range(cols):
+        children = []
+        for children_row in (bottom, top):
+            for cx in (ix * 2, ix * 2 + 1):
+                if children_row is None or cx >= len(children_row):
+                    children.append(None)
+                else:
+                    children.append(children_row[cx])
+        row.append(_merge_tiles(children, tile_size))
+    return row
+
+
+def _image_bands(im, rows, tile_size):
+    """Yield (iy, band) for each row of full resolution tiles, from the top,
+    band being the part of the image covered by the row.
+    """
+    w, h = im.size
+    for iy in range(rows - 1, -1, -1):
+        top = max(0, h - (iy + 1) * tile_size)
+        bottom = max(0, h - iy * tile_size)
+        yield iy, im.crop((0, top, w, bottom))
+
+
+def _tiff_bits_per_pixel(im):
+    bits = im.tag_v2.get(258, 1)
+    if isinstance(bits, tuple):
+        return sum(bits)
+    return bits * im.tag_v2.get(277, 1)
+
+
+def _read_tiff_band(source, tiles, bits, top, bottom):
+    """Decode the rows top to bottom of an uncompressed TIFF, reading only the
+    parts of its strips (or tiles) covering them.
+    """
+    band = Image.open(source)
+    w = band.size[0]
+    if bottom <= top:
+        return Image.new(band.mode, (w, 0))
+    band_tiles = []
+    for tile in tiles:
+        decoder, (x0, y0, x1, y1), offset, args = tile
+        if y1 <= top or y0 >= bottom:
+            continue
+        stride = args[1] or ((x1 - x0) * bits + 7) // 8
+        band_top = max(y0, top)
+        band_bottom = min(y1, bottom)
+        band_tile = (decoder, (x0, band_top - top, x1, band_bottom - top),
+                     offset + (band_top - y0) * stride, args)
+        if hasattr(tile, "_make"):
+            band_tile = tile._make(band_tile)
+        band_tiles.append(band_tile)
+    band._size = (w, bottom - top)
+    if hasattr(band, "_tile_size"):
+        # size of the decoded image since Pillow 9
+        band._tile_size = band._size
+    band.tile = band_tiles
+    band.load()
+    return band
+
+
+def _band_reader(source):
+    """Get a function reading the rows top to bottom of the source, converted
+    to the mode of the tiles (see _tile_mode()), without decoding the others.
+    Only uncompressed TIFF can be read this way (None for other sources).
+    """
     im = Image.open(source)
+    streamable = (im.format == "TIFF"
+                  and im.tag_v2.get(284, 1) == 1
+                  and all(tile[0] == "raw" and tile[3][2] == 1
+                          for tile in im.tile))
+    if not streamable:
+        return None
+    bits = _tiff_bits_per_pixel(im)
+    return lambda top, bottom: _tile_mode(
+        _read_tiff_band(source, im.tile, bits, top, bottom))
+
+
+def _read_bands(source, rows, tile_size):
+    """Same as _image_bands(), but reading the source by bands, converted to
+    the mode of the tiles. Sources that cannot be read by bands (see
+    _band_reader()) are decoded at once.
+    """
+    read_band = _band_reader(source)
+    if read_band is None:
+        print("-> Cannot read {} by bands, decode the whole image".format(
+            source))
+        im = Image.open(source)
+        im.load()
+        for band in _image_bands(_tile_mode(im), rows, tile_size):
+            yield band
+        return
+
+    h = Image.open(source).size[1]
+    for iy in range(rows - 1, -1, -1):
+        top = max(0, h - (iy + 1) * tile_size)
+        bottom = max(0, h - iy * tile_size)
+        yield iy, read_band(top, bottom)
+
+
+def _open_scratch(source, scratch, band_height=256, mode=None):
+    """Decode the source once into `scratch`, an uncompressed raster, and
+    return it mapped as an image: crops are read from the page cache, shared
+    by all the processes. The raster has the mode of the tiles (see
+    _tile_mode()), RGB being stored as RGBX, unless `mode` is given. The
+    scratch file is reused as long as the source keeps the same size and
+    modification time (and mode).
+    """
+    st = stat(source)
+    key = [abspath(source), st.st_size, st.st_mtime]
+    info_filename = scratch + ".json"
+    info = None
+    if exists(scratch) and exists(info_filename):
+        with open(info_filename) as fd:
+            info = json.load(fd)
+        if info["source"] != key or mode not in (None, info["mode"]):
+            info = None
+
+    if info is None:
+        print("-> Decode {} into {}".format(source, scratch))
+        im = Image.open(source)
+        w, h = im.size
+        rows = int(ceil(h / float(band_height)))
+        with open(scratch, "wb") as fd:
+            for iy, band in _read_bands(source, rows, band_height):
+                if mode is None:
+                    # RGB is stored on 4 bytes, in order to be mapped
+                    mode = "RGBX" if band.mode == "RGB" else band.mode
+                fd.write(band.convert(mode).tobytes())
+        info = {"source": key, "size": [w, h], "mode": mode}
+        with open(info_filename, "w") as fd:
+            json.dump(info, fd)
+    else:
+        print("-> Reuse {}".format(scratch))
+
+    with open(scratch, "rb") as fd:
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+    mode = info["mode"]
+    return Image.frombuffer(mode, tuple(info["size"]), data, "raw", mode, 0, 1)
+
+
+def export_pyramid(writer,
+                   size,
+                   bands,
+                   max_zoom,
+                   tile_size,
+                   progress,
+                   tilesdir,
+                   workers=1,
+                   skip_empty=False,
+                   encoder=None):
+    """Generate all the levels at once: only the full resolution level is cut
+    out of the source image, each tile of the level N-1 being built from the 2x2
+    tiles of the level N. Only the rows waiting for their sibling are kept in
+    memory.
+
+    The source image is given by `bands`, yielding (iy, band) from the top
+    row of full resolution tiles to the bottom one (see _image_bands()).
+
+    With workers, the tiles are encoded by a pool of processes, while the
+    tiles themselves are built in the main process.
+    """
+    w, h = size
+    grids = [
+        _level_grid(w, h, max_zoom, zoom, tile_size)
+        for zoom in range(max_zoom + 1)
+    ]
+    pending = [{} for zoom in range(max_zoom + 1)]
+
+    print("-> Generate pyramid from zoom {}".format(max_zoom))
+    _render_state.clear()
+    _render_state["dedup"] = writer.dedup
+    _render_state["skip_empty"] = skip_empty
+    _render_state["encoder"] = encoder
+    _render_state["func"] = _encode_tile
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers)
+        if STAGE_TIMERS:
+            encode = lambda row: list(_collect_stage_times(
+                pool.map(_run_timed, row)))
+        else:
+            encode = lambda row: pool.map(_encode_tile, row)
+    else:
+        pool = None
+        encode = lambda row: [_encode_tile(tile) for tile in row]
+
+    # when resuming, the existing tiles are still built (for their parents),
+    # but not encoded again
+    existing = [
+        writer.existing_tiles(max_zoom - zoom) if writer.resumed else ()
+        for zoom in range(max_zoom + 1)
+    ]
+
+    cols, rows = grids[0]
+    for base_iy, band in bands:
+        zoom = 0
+        iy = base_iy
+        # the band is exactly one row tall, so each tile is at row 0 of it
+        row = [_crop_tile(band, 0, ix, 0, tile_size) for ix in range(cols)]
+        band = None
+        while row is not None:
+            missing = [
+                ix for ix in range(len(row)) if (ix, iy) not in existing[zoom]
+            ]
+            progress.add_total(len(missing) - len(row))
+            encoded = encode([row[ix] for ix in missing])
+            for ix, (tile_id, data) in zip(missing, encoded):
+                if VERBOSE:
+                    print("  - {}/{}\t zoom:{}\tix:{}\tiy:{}".format(
+                        progress.done + 1, progress.total, zoom, ix, iy))
+                _write_tile(writer, max_zoom - zoom, ix, iy, data, tilesdir,
+                            tile_id)
+                progress.update(max_zoom - zoom)
+            if zoom == max_zoom:
+                break
+
+            # build the parent row as soon as both of its children rows exist
+            pending[zoom][iy] = row
+            row = None
+            parent_iy = iy // 2
+            siblings = [
+                child_iy for child_iy in (parent_iy * 2, parent_iy * 2 + 1)
+                if child_iy < grids[zoom][1]
+            ]
+            if all(child_iy in pending[zoom] for child_iy in siblings):
+                bottom = pending[zoom].pop(parent_iy * 2)
+                top = pending[zoom].pop(parent_iy * 2 + 1, None)
+                zoom += 1
+                iy = parent_iy
+                row = _merge_rows(bottom, top, grids[zoom][0], tile_size)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _in_shard(tile_col, tile_row, shard):
+    """Tell if a tile belongs to a shard (index, count), the index starting
+    at 1. Tiles are dealt by diagonals, so each shard gets a part of every
+    level.
+    """
+    index, count = shard
+    return (tile_col + tile_row) % count == index - 1
+
+
+class TilePlan(object):
+    """Tiles to generate, in the order of their generation, as arrays: the
+    zoom, col and row (TMS) of each tile, and the window of the source it
+    covers (x0, y0, x1, y1, in pixels of a source of `size` from its top left
+    corner, possibly beyond it).
+    """
+
+    def __init__(self, size, zoom, col, row, window):
+        self.size = size
+        self.zoom = zoom
+        self.col = col
+        self.row = row
+        self.window = window
+
+    @classmethod
+    def grid(cls, size, zoom, cols, rows, window):
+        """Plan the tiles of a level, col by col, from the ranges of its cols
+        and rows. `window` gives the windows of the (col, row) arrays.
+        """
+        col, row = np.meshgrid(
+            np.arange(cols.start, cols.stop, dtype=np.int64),
+            np.arange(rows.start, rows.stop, dtype=np.int64),
+            indexing="ij")
+        col = col.ravel()
+        row = row.ravel()
+        return cls(size, np.full(len(col), zoom, np.uint8), col, row,
+                   window(col, row))
+
+    @classmethod
+    def concatenate(cls, size, plans):
+        if not plans:
+            return cls(size, np.zeros(0, np.uint8), np.zeros(0, np.int64),
+                       np.zeros(0, np.int64), np.zeros((0, 4)))
+        return cls(size, *[
+            np.concatenate([getattr(plan, name) for plan in plans])
+            for name in ("zoom", "col", "row", "window")
+        ])
+
+    def __len__(self):
+        return len(self.zoom)
+
+    def select(self, mask):
+        return TilePlan(self.size, self.zoom[mask], self.col[mask],
+                        self.row[mask], self.window[mask])
+
+    def level(self, zoom):
+        return self.select(self.zoom == zoom)
+
+    def shard(self, shard):
+        return self.select(_in_shard(self.col, self.row, shard))
+
+    def exclude(self, zoom, existing):
+        """Remove the tiles of a zoom found in `existing`, a set of (col,
+        row)
+        """
+        if not existing:
+            return self
+        keys = np.array([(col << 32) + row for col, row in existing],
+                        np.int64)
+        return self.select((self.zoom != zoom) | ~np.isin(
+            (self.col << 32) + self.row, keys))
+
+    def tasks(self):
+        return list(zip(self.col.tolist(), self.row.tolist()))
+
+    def clipped_window(self):
+        w, h = self.size
+        return np.clip(self.window, 0, [w, h, w, h])
+
+    def summary(self):
+        """Get the number of tiles, of source pixels they cover, and the sum
+        of the covered part of each tile, by zoom
+        """
+        x0, y0, x1, y1 = self.window.T
+        cx0, cy0, cx1, cy1 = self.clipped_window().T
+        area = (cx1 - cx0) * (cy1 - cy0)
+        pixels = np.bincount(self.zoom, weights=area, minlength=256)
+        covered = np.bincount(
+            self.zoom, weights=area / ((x1 - x0) * (y1 - y0)), minlength=256)
+        zooms, counts = np.unique(self.zoom, return_counts=True)
+        return [(int(zoom), int(count), int(pixels[zoom]), covered[zoom])
+                for zoom, count in zip(zooms, counts)]
+
+
+def plan_image(w, h, max_zoom, tile_size, region=None, shard=None):
+    """Plan the tiles of export(), from the lowest zoom to the full resolution
+    one (max_zoom). With `region` (x, y, w, h), only the tiles covering it.
+    """
+    plans = []
+    for zoom in range(max_zoom, -1, -1):
+        step = tile_size * (2**zoom)
+        cols, rows = _level_grid(w, h, max_zoom, zoom, tile_size)
+        col_range = range(cols)
+        row_range = range(rows)
+        if region is not None:
+            x, y, region_w, region_h = region
+            col_range = range(
+                max(0, x // step), min(cols, (x + region_w - 1) // step + 1))
+            row_range = range(
+                max(0, (h - y - region_h) // step),
+                min(rows, (h - y - 1) // step + 1))
+
+        def window(col, row):
+            x = col * step
+            y = h - row * step
+            return np.stack([x, y - step, x + step, y], axis=1)
+
+        plans.append(
+            TilePlan.grid((w, h), max_zoom - zoom, col_range, row_range,
+                          window))
+    plan = TilePlan.concatenate((w, h), plans)
+    return plan.shard(shard) if shard is not None else plan
+
+
+def plan_lnglat(w, h, lng, lat, im_mpx, target_zoom, tile_size, shard=None):
+    """Plan the tiles of export_lnglat(), from `target_zoom` down to the zoom
+    where the image is less than 1 px. Return the plan, and the levels:
+    (zoom, target_mpx, zoom_ratio, tw, th, center_x, center_y, x_min, y_min,
+    tile_cols, tile_rows), in pixels of the image resized for the zoom.
+    """
+    levels = []
+    plans = []
+    for zoom in range(target_zoom, -1, -1):
+        target_mpx = meters_per_pixel(lat, zoom)
+        zoom_ratio = im_mpx / target_mpx
+        tw = int(w * zoom_ratio)
+        th = int(h * zoom_ratio)
+        if min(tw, th) <= 1:
+            break
+        center_x = get_x(zoom, lng, tile_size=tile_size)
+        center_y = get_y(zoom, lat, tile_size=tile_size)
+        x_min = int(center_x - (tw / 2))
+        y_min = int(center_y - (th / 2))
+        tile_cols = range(
+            int(floor(x_min / float(tile_size))),
+            int(floor((x_min + tw) / float(tile_size))) + 1)
+        tile_rows = range(
+            int(floor(y_min / float(tile_size))),
+            int(floor((y_min + th) / float(tile_size))) + 1)
+        levels.append((zoom, target_mpx, zoom_ratio, tw, th, center_x,
+                       center_y, x_min, y_min, tile_cols, tile_rows))
+
+        def window(col, row):
+            x = col * tile_size - x_min
+            y = th - (row * tile_size - y_min)
+            return np.stack([x, y - tile_size, x + tile_size, y],
+                            axis=1) / zoom_ratio
+
+        plans.append(
+            TilePlan.grid((w, h), zoom, tile_cols, tile_rows, window))
+    plan = TilePlan.concatenate((w, h), plans)
+    return (plan.shard(shard) if shard is not None else plan), levels
+
+
+def plan_svg(w, h, lng, lat, im_mpx, minzoom, maxzoom, tile_size,
+             shard=None):
+    """Plan the tiles of export_lnglat_svg(), from `minzoom` to `maxzoom`. The
+    windows are the areas rendered, in the svg units. Return the plan, and
+    the levels: (zoom, target_mpx, zoom_ratio, tw, th, center_x, center_y,
+    x_min, y_min, tile_cols, tile_rows).
+    """
+    levels = []
+    plans = []
+    for zoom in range(minzoom, maxzoom + 1):
+        target_mpx = meters_per_pixel(lat, zoom)
+        zoom_ratio = im_mpx / target_mpx
+        tw = w * zoom_ratio
+        th = h * zoom_ratio
+        center_x = get_x(zoom, lng, tile_size=tile_size)
+        center_y = get_y(zoom, lat, tile_size=tile_size)
+        x_min = center_x - (tw / 2)
+        y_min = center_y - (th / 2)
+        tile_cols = range(
+            int(floor(x_min / float(tile_size))),
+            int(floor((x_min + tw) / float(tile_size))) + 1)
+        tile_rows = range(
+            int(floor(y_min / float(tile_size))),
+            int(floor((y_min + th) / float(tile_size))) + 1)
+        levels.append((zoom, target_mpx, zoom_ratio, tw, th, center_x,
+                       center_y, x_min, y_min, tile_cols, tile_rows))
+
+        def window(col, row):
+            x = col * tile_size - x_min
+            y = row * tile_size - y_min
+            return np.stack([x, y, x + tile_size, y + tile_size],
+                            axis=1) * (1 / zoom_ratio)
+
+        plans.append(
+            TilePlan.grid((w, h), zoom, tile_cols, tile_rows, window))
+    plan = TilePlan.concatenate((w, h), plans)
+    return (plan.shard(shard) if shard is not None else plan), levels
+
+
+def _sample_tile_bytes(im, encoder, tile_size, samples=16, read_band=None):
+    """Get the average size of the tiles cut at full resolution at regular
+    intervals of the image, once encoded. With `read_band` (see
+    _band_reader()), only the rows of the samples are read from the source.
+    """
+    w, h = im.size
+    n = int(ceil(samples**.5))
+    sizes = []
+    for j in range(n):
+        y = int(max(0, h - tile_size) * (j + .5) / n)
+        band, top = im, 0
+        if read_band is not None:
+            band, top = read_band(y, min(h, y + tile_size)), y
+        for i in range(n):
+            x = int(max(0, w - tile_size) * (i + .5) / n)
+            with _stage("crop"):
+                tile = band.crop(
+                    (x, y - top, x + tile_size, y - top + tile_size))
+                tile = tile.convert("RGB") if tile.mode == "RGBX" else \
+                    _tile_mode(tile)
+            sizes.append(len(encoder.encode(tile)))
+    return sum(sizes) / float(len(sizes))
+
+
+def print_plan(plan, tile_bytes=None):
+    """Print the number of tiles and of source pixels read by zoom, and the
+    size of the output estimated from the average size of a tile covered by
+    the source
+    """
+    print("Plan: {} tiles".format(len(plan)))
+    total = 0
+    for zoom, tiles, pixels, covered in plan.summary():
+        if tile_bytes is None:
+            print("  - Zoom {}: {} tiles, {} source pixels".format(
+                zoom, tiles, pixels))
+            continue
+        total += covered * tile_bytes
+        print("  - Zoom {}: {} tiles, {} source pixels, {:.1f} MB".format(
+            zoom, tiles, pixels, covered * tile_bytes / 1e6))
+    if tile_bytes is not None:
+        print("Estimated size: {:.1f} MB ({} bytes per tile)".format(
+            total / 1e6, int(tile_bytes)))
+
+
+def export(source,
+           dest,
+           tilesdir,
+           tile_size=256,
+           pyramid=False,
+           workers=1,
+           dedup=False,
+           skip_empty=False,
+           stream=False,
+           scratch=None,
+           resume=False,
+           update_region=None,
+           encoder=None,
+           shard=None,
+           metrics=None,
+           dry_run=False):
+    print("Analyse: {}".format(source))
+    if scratch is not None:
+        im = _open_scratch(source, scratch)
+        stream = False
+    else:
+        im = Image.open(source)
+    if not stream and not dry_run and (pyramid or update_region is not None):
+        # decode once, before the rendering processes are forked
+        with _stage("decode"):
+            im.load()
+        if scratch is None:
+            im = _tile_mode(im)
     w, h = im.size
     print("Size: {}x{}".format(w, h))
     side = max(w, h)
     print("Mode: {}".format(im.mode))
-    max_zoom = int(ceil(log(side / float(tile_size), 2)))
+    # a source smaller than a tile still gets its zoom 0 tile
+    max_zoom = max(0, int(ceil(log(side / float(tile_size), 2))))
     print("Maximum zoom: {}".format(max_zoom))
-    max_tiles = _estimate_tiles(w, h, max_zoom, tile_size)
-    counter = 1
-    print("Estimated tiles: {}".format(max_tiles))
-
-    conn = sqlite3.connect(dest)
-    c = conn.cursor()
-
-    # create database schema
-    c.execute('CREATE TABLE metadata (name text, value text)')
-    c.execute(
-        'CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)'
-    )
-    # indicies aren't necessary but for large databases with many zoom levels
-    # may increase performance
-    c.execute(
-        'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)'
-    )
-    c.execute('CREATE UNIQUE INDEX name ON metadata (name)')
+    if encoder is None:
+        encoder = TileEncoder()
+    plan = plan_image(
+        w, h, max_zoom, tile_size, region=update_region, shard=shard)
+    if dry_run:
+        # like the export, --stream reads the samples by bands
+        read_band = _band_reader(source) if stream else None
+        print_plan(plan, _sample_tile_bytes(im, encoder, tile_size,
+                                            read_band=read_band))
+        return
+
+    writer = MBTilesWriter(
+        dest, dedup=dedup, resume=resume or update_region is not None)
+    writer.check_encoder(encoder)
+    # the pyramid builds the existing tiles again, for their parents
+    if writer.resumed and update_region is None and not (pyramid or stream):
+        for zoom in range(max_zoom + 1):
+            plan = plan.exclude(zoom, writer.existing_tiles(zoom))
+    print("Tiles: {}".format(len(plan)))
+    progress = Progress(len(plan), metrics)
+    if tilesdir is not None:
+        tilesdir = TilesDirWriter(tilesdir, encoder.extension)
 
     # fill metadata table with some basic info
-    c.execute("INSERT INTO metadata VALUES ('name', ?)", [dest])
-    c.execute("INSERT INTO metadata VALUES ('type', 'baselayer')")
-    c.execute("INSERT INTO metadata VALUES ('version', '1.0')")
-    c.execute("INSERT INTO metadata VALUES ('description', '')")
-    c.execute("INSERT INTO metadata VALUES ('format', 'png')")
-    c.execute("INSERT INTO metadata VALUES ('minzoom', '0')")
-    c.execute("INSERT INTO metadata VALUES ('maxzoom', ?)", [max_zoom])
-    c.execute("INSERT INTO metadata VALUES ('projection', 'xy')")
-
-    for zoom in range(max_zoom, -1, -1):
-        counter = export_level(
-            c,
-            im,
+    writer.add_metadata("name", dest)
+    writer.add_metadata("type", "baselayer")
+    writer.add_metadata("version", "1.0")
+    writer.add_metadata("description", "")
+    writer.add_metadata("format", encoder.format)
+    writer.add_metadata("minzoom", 0)
+    if shard is not None:
+        writer.add_metadata("shard", "{}/{}".format(*shard))
+    writer.add_metadata("maxzoom", max_zoom)
+    writer.add_metadata("projection", "xy")
+
+    if update_region is not None:
+        # the tiles covering the region are cut again from the source, at
+        # every level
+        for zoom in range(max_zoom, -1, -1):
+            export_level(
+                writer,
+                im,
+                max_zoom,
+                zoom,
+                tile_size,
+                progress,
+                tilesdir=tilesdir,
+                plan=plan.level(max_zoom - zoom),
+                workers=workers,
+                skip_empty=skip_empty,
+                encoder=encoder)
+            writer.flush()
+    elif pyramid or stream:
+        rows = _level_grid(w, h, max_zoom, 0, tile_size)[1]
+        if stream:
+            bands = _read_bands(source, rows, tile_size)
+        else:
+            bands = _image_bands(im, rows, tile_size)
+        export_pyramid(
+            writer,
+            im.size,
+            bands,
             max_zoom,
-            zoom,
             tile_size,
-            counter,
-            max_tiles,
-            tilesdir=tilesdir)
-        conn.commit()
-    conn.close()
+            progress,
+            tilesdir=tilesdir,
+            workers=workers,
+            skip_empty=skip_empty,
+            encoder=encoder)
+    else:
+        # the lowest levels are cut out of a reduced source, when the decoder
+        # provides one
+        reduced = {}
+        for zoom in range(max_zoom, -1, -1):
+            level_im = None
+            if scratch is None:
+                level_im = _open_reduced(source, 2**zoom, reduced)
+            if level_im is None:
+                # decode once, before the rendering processes are forked
+                with _stage("decode"):
+                    im.load()
+                if scratch is None:
+                    im = _tile_mode(im)
+                level_im = im
+            else:
+                print("-> Reduced source: {}x{}".format(*level_im.size))
+            export_level(
+                writer,
+                level_im,
+                max_zoom,
+                zoom,
+                tile_size,
+                progress,
+                tilesdir=tilesdir,
+                plan=plan.level(max_zoom - zoom),
+                workers=workers,
+                skip_empty=skip_empty,
+                encoder=encoder,
+                size=(w, h) if level_im is not im else None)
+            writer.flush()
+    if tilesdir is not None:
+        tilesdir.close()
+    writer.close()
+    progress.close()
 
 
 def meters_per_pixel(lat, zoom):
@@ -194,6 +1462,118 @@ def flip_y(y, z):
     return 2**z - 1 - y
 
 
+def _render_lnglat_tile(task):
+    tile_col, tile_row = task
+    im2 = _render_state["im"]
+    tile_size = _render_state["tile_size"]
+    x_min = _render_state["x_min"]
+    y_min = _render_state["y_min"]
+    th = im2.size[1]
+
+    tile_x = tile_col * tile_size
+    tile_y = tile_row * tile_size
+
+    crop_x = max(0, tile_x - x_min)
+    crop_y = max(0, tile_y - y_min)
+    crop_x2 = min(tile_x + tile_size, tile_x + tile_size - x_min)
+    crop_y2 = min(tile_y + tile_size, tile_y + tile_size - y_min)
+    crop_w = crop_x2 - crop_x
+    crop_h = crop_y2 - crop_y
+
+    with _stage("crop"):
+        imc = im2.crop((crop_x, th - crop_y2, crop_x2, th - crop_y))
+    if crop_w <= 0 or crop_h <= 0:
+        imc = None
+
+    box_x = max(0, x_min - tile_x)
+    box_y = max(0, y_min - tile_y)
+    box_y = 0
+    if VERBOSE:
+        print("  - Crop {}x{} to {}x{}".format(crop_x, crop_y, crop_x2,
+                                               crop_y2))
+        print("  - Crop size: {}x{}".format(crop_w, crop_h))
+        print("  - Box: {}x{}".format(box_x, box_y))
+    return _compose_lnglat_tile(imc, (box_x, box_y), tile_col, tile_row)
+
+
+def _compose_lnglat_tile(imc, box, tile_col, tile_row):
+    """Paste the part of the image visible in a tile over a white tile, and
+    encode it
+    """
+    tile_size = _render_state["tile_size"]
+    if _render_state["skip_empty"] and (imc is None
+                                        or imc.getextrema()[3][1] == 0):
+        # nothing of the image is visible in this tile
+        return None, None
+
+    im3 = _reusable_canvas("RGBA", (tile_size, tile_size))
+    if DEBUG_TILES:
+        draw = ImageDraw.Draw(im3)
+        draw.rectangle(
+            (0, 0, tile_size, tile_size),
+            outline="#0000ffff",
+            fill="#ff000066")
+        draw.text(
+            (10, 10),
+            "ZOOM {} - {}x{}".format(_render_state["zoom"], tile_col,
+                                     tile_row),
+            font=_render_state["font"],
+            fill=(0, 0, 0, 255))
+
+    with _stage("crop"):
+        # fill with white !
+        im3.paste((255, 255, 255), (0, 0, im3.size[0], im3.size[1]))
+
+        if imc is not None:
+            im3.paste(imc, box=box, mask=imc)
+    return _encode_tile(im3)
+
+
+def _rotation_matrix(w, h, angle):
+    """Get the affine matrix mapping the pixels of an image rotated by angle
+    (with expand, as done by Image.rotate()) to the pixels of the original
+    image, and the size of the rotated image.
+    """
+    angle = -radians(angle % 360.)
+    a = round(cos(angle), 15)
+    b = round(sin(angle), 15)
+    d = round(-sin(angle), 15)
+    e = round(cos(angle), 15)
+    corners = [(a * x + b * y, d * x + e * y)
+               for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    nw = int(ceil(max(x for x, y in corners)) -
+             floor(min(x for x, y in corners)))
+    nh = int(ceil(max(y for x, y in corners)) -
+             floor(min(y for x, y in corners)))
+    # rotate around the center of both images
+    x, y = -nw / 2., -nh / 2.
+    c = a * x + b * y + w / 2.
+    f = d * x + e * y + h / 2.
+    return (a, b, c, d, e, f), (nw, nh)
+
+
+def _render_warped_tile(task):
+    """Build a tile of a rotated image straight from the unrotated source,
+    with a single affine transformation
+    """
+    tile_col, tile_row = task
+    im = _render_state["im"]
+    tile_size = _render_state["tile_size"]
+    x_min = _render_state["x_min"]
+    y_min = _render_state["y_min"]
+    th = _render_state["th"]
+    a, b, c, d, e, f = _render_state["matrix"]
+
+    # position of the tile in the rotated image resized for this zoom
+    ox = tile_col * tile_size - x_min
+    oy = th - tile_size - (tile_row * tile_size - y_min)
+    matrix = (a, b, a * ox + b * oy + c, d, e, d * ox + e * oy + f)
+    with _stage("resize"):
+        imc = im.transform((tile_size, tile_size), Image.AFFINE, matrix,
+                           RESAMPLE).convert("RGBA")
+    return _compose_lnglat_tile(imc, (0, 0), tile_col, tile_row)
+
+
 def export_lnglat(source,
                   dest,
                   center,
@@ -201,10 +1581,23 @@ def export_lnglat(source,
                   rotation,
                   tilesdir,
                   tile_size=256,
-                  px=False):
+                  px=False,
+                  workers=1,
+                  dedup=False,
+                  skip_empty=False,
+                  scratch=None,
+                  resume=False,
+                  encoder=None,
+                  shard=None,
+                  metrics=None,
+                  dry_run=False):
     lng, lat = map(float, center.split(","))
     print("Analyse: {}".format(source))
-    im = Image.open(source).convert("RGBA")
+    if scratch is not None:
+        # mapped as RGBA, so it is used without being converted
+        im = _open_scratch(source, scratch, mode="RGBA")
+    else:
+        im = Image.open(source)
     w, h = im.size
     print("Size: {}x{}".format(w, h))
     print("Current position: {},{}".format(lng, lat))
@@ -212,9 +1605,10 @@ def export_lnglat(source,
     print("Current meter per pixels: {}".format(im_mpx))
 
     if rotation:
+        # instead of rotating the whole image, each tile is warped from the
+        # source, with premultiplied alpha as Image.rotate() would do
         print("Rotation: {}".format(rotation))
-        im = im.rotate(rotation, resample=Image.BICUBIC, expand=True)
-        w, h = im.size
+        rotation_matrix, (w, h) = _rotation_matrix(w, h, rotation)
         print("New size: {}x{}".format(w, h))
 
     # search for the maximum zoom that would fit the current mpx
@@ -230,137 +1624,205 @@ def export_lnglat(source,
         meterswidth = w * im_mpx
         print("PX mode: calculated width: {} meters".format(meterswidth))
 
-    conn = sqlite3.connect(dest)
-    c = conn.cursor()
-
-    # create database schema
-    c.execute('CREATE TABLE metadata (name text, value text)')
-    c.execute(
-        'CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)'
-    )
-    # indicies aren't necessary but for large databases with many zoom levels
-    # may increase performance
-    c.execute(
-        'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)'
-    )
-    c.execute('CREATE UNIQUE INDEX name ON metadata (name)')
+    if encoder is None:
+        encoder = TileEncoder()
+    plan, levels = plan_lnglat(w, h, lng, lat, im_mpx, target_zoom, tile_size,
+                               shard)
+    min_zoom = levels[-1][0] if levels else target_zoom
+    if dry_run:
+        print_plan(plan, _sample_tile_bytes(im, encoder, tile_size))
+        return
+
+    if im.mode != "RGBA":
+        with _stage("decode"):
+            im = im.convert("RGBA")
+    if rotation:
+        # a copy, even of a scratch file: the warp needs premultiplied alpha
+        im = im.convert("RGBa")
+    writer = MBTilesWriter(dest, dedup=dedup, resume=resume)
+    writer.check_encoder(encoder)
+    if tilesdir is not None:
+        tilesdir = TilesDirWriter(tilesdir, encoder.extension)
 
     # fill metadata table with some basic info
-    c.execute("INSERT INTO metadata VALUES ('name', ?)", [dest])
-    c.execute("INSERT INTO metadata VALUES ('type', 'baselayer')")
-    c.execute("INSERT INTO metadata VALUES ('version', '1.0')")
-    c.execute("INSERT INTO metadata VALUES ('description', '')")
-    c.execute("INSERT INTO metadata VALUES ('format', 'png')")
-
-    min_zoom = target_zoom
-    for zoom in range(target_zoom, -1, -1):
+    writer.add_metadata("name", dest)
+    writer.add_metadata("type", "baselayer")
+    writer.add_metadata("version", "1.0")
+    writer.add_metadata("description", "")
+    writer.add_metadata("format", encoder.format)
+    if shard is not None:
+        writer.add_metadata("shard", "{}/{}".format(*shard))
+
+    if writer.resumed:
+        for level in levels:
+            plan = plan.exclude(level[0], writer.existing_tiles(level[0]))
+    progress = Progress(len(plan), metrics)
+
+    # each level is resampled from the previous one (about twice as large)
+    # instead of the source, which is released after the first level smaller
+    # than it: only the rasters of two levels are in memory at a time
+    previous = im
+    factor = 1
+    im = None
+    for (zoom, target_mpx, zoom_ratio, tw, th, center_x, center_y, x_min,
+         y_min, tile_cols, tile_rows) in levels:
         print("Process zoom {}".format(zoom))
-        target_mpx = meters_per_pixel(lat, zoom)
         print("  - Target meter per pixels: {}".format(target_mpx))
-        zoom_ratio = im_mpx / target_mpx
-        tw = int(w * zoom_ratio)
-        th = int(h * zoom_ratio)
-        if min(tw, th) <= 1:
-            print("  - Stopped now, image less than 1 px")
-            min_zoom = zoom + 1
-            break
         print("  - Image size: {}x{}".format(tw, th))
 
-        im2 = im.resize((tw, th), RESAMPLE)
+        with _stage("resize"):
+            if rotation:
+                # halve the source (averaging 2x2 pixels) until the affine
+                # transformation scales by less than 2, where it is accurate
+                sx = w / float(tw)
+                sy = h / float(th)
+                while factor * 2 <= min(sx, sy):
+                    previous = previous.reduce(2)
+                    factor *= 2
+                im2 = previous
+                a, b, c, d, e, f = [v / factor for v in rotation_matrix]
+                matrix = (a * sx, b * sy, c, d * sx, e * sy, f)
+            else:
+                im2 = previous.resize((tw, th), RESAMPLE)
+                if tw <= w:
+                    # the upscaled levels would only add blur
+                    previous = im2
 
         cols = get_col_count(zoom)
         rows = get_row_count(zoom)
         print("  - Maximum number of cols/rows: {}x{}".format(cols, rows))
-        center_x = get_x(zoom, lng, tile_size=tile_size)
-        center_y = get_y(zoom, lat, tile_size=tile_size)
         print("  - Center in pixels is: {}x{}".format(center_x, center_y))
-        x_min = int(center_x - (tw / 2))
-        y_min = int(center_y - (th / 2))
         print("  - Minimum x/y: {}x{}".format(x_min, y_min))
-        x_max = x_min + tw
-        y_max = y_min + th
-        print("  - Maximum x/y: {}x{}".format(x_max, y_max))
-        tile_col_min = int(floor(x_min / float(tile_size)))
-        tile_row_min = int(floor(y_min / float(tile_size)))
-        tile_col_max = int(floor(x_max / float(tile_size)))
-        tile_row_max = int(floor(y_max / float(tile_size)))
-        tile_col_count = max(1, tile_col_max - tile_col_min)
-        tile_row_count = max(1, tile_row_max - tile_row_min)
+        print("  - Maximum x/y: {}x{}".format(x_min + tw, y_min + th))
         print("  - Tile range: {}x{} to {}x{}".format(
-            tile_col_min, tile_row_min, tile_col_max, tile_row_max))
-        print("  - Cols count: {}".format(tile_col_count))
-        print("  - Rows count: {}".format(tile_row_count))
+            tile_cols[0], tile_rows[0], tile_cols[-1], tile_rows[-1]))
+        print("  - Cols count: {}".format(len(tile_cols)))
+        print("  - Rows count: {}".format(len(tile_rows)))
 
-        count = tile_col_count * tile_row_count
-        index = 0
+        font = None
         if DEBUG_TILES:
             font = ImageFont.truetype("/usr/share/fonts/TTF/Arimo-Regular.ttf",
                                       14)
-        for tile_col in range(tile_col_min, tile_col_max + 1):
-            for tile_row in range(tile_row_min, tile_row_max + 1):
-                index += 1
+        tasks = plan.level(zoom).tasks()
+        results = _imap_tiles(
+            _render_warped_tile if rotation else _render_lnglat_tile,
+            tasks,
+            workers,
+            im=im2,
+            zoom=zoom,
+            tile_size=tile_size,
+            x_min=x_min,
+            y_min=y_min,
+            th=th,
+            matrix=matrix if rotation else None,
+            font=font,
+            dedup=writer.dedup,
+            skip_empty=skip_empty,
+            encoder=encoder)
+        for (tile_col, tile_row), (tile_id, data) in zip(tasks, results):
+            if VERBOSE:
                 print("  - {}/{}\tcol:{} row:{}".format(
-                    index, count, tile_col, tile_row))
-
-                tile_x = tile_col * tile_size
-                tile_y = tile_row * tile_size
-
-                crop_x = max(0, tile_x - x_min)
-                crop_y = max(0, tile_y - y_min)
-                crop_x2 = min(tile_x + tile_size, tile_x + tile_size - x_min)
-                crop_y2 = min(tile_y + tile_size, tile_y + tile_size - y_min)
-                print("  - Crop {}x{} to {}x{}".format(crop_x, crop_y, crop_x2,
-                                                       crop_y2))
-                crop_w = crop_x2 - crop_x
-                crop_h = crop_y2 - crop_y
-                print("  - Crop size: {}x{}".format(crop_w, crop_h))
-
-                im3 = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
-                if DEBUG_TILES:
-                    draw = ImageDraw.Draw(im3)
-                    draw.rectangle(
-                        (0, 0, tile_size, tile_size),
-                        outline="#0000ffff",
-                        fill="#ff000066")
-                    draw.text(
-                        (10, 10),
-                        "ZOOM {} - {}x{}".format(zoom, tile_col, tile_row),
-                        font=font,
-                        fill=(0, 0, 0, 255))
-                imc = im2.crop((crop_x, th - crop_y2, crop_x2, th - crop_y))
-
-                box_x = max(0, x_min - tile_x)
-                box_y = max(0, y_min - tile_y)
-                box_y = 0
-                print("  - Box: {}x{}".format(box_x, box_y))
-
-                # fill with white !
-                im3.paste((255, 255, 255), (0, 0, im3.size[0], im3.size[1]))
-
-                im3.paste(imc, box=(box_x, box_y), mask=imc)
-                sio = BytesIO()
-                im3.save(sio, format="PNG")
-                c.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)",
-                          [zoom, tile_col, tile_row, sio.getvalue()])
-                conn.commit()
-
-                if tilesdir is not None:
-                    filename = join(tilesdir,
-                                    str(zoom),
-                                    str(tile_col),
-                                    "{}.png".format(flip_y(tile_row, zoom)))
-                    directory = dirname(filename)
-                    if not exists(directory):
-                        makedirs(directory)
-                    im3.save(filename, format="PNG")
+                    progress.done + 1, progress.total, tile_col, tile_row))
+            _write_tile(writer, zoom, tile_col, tile_row, data, tilesdir,
+                        tile_id)
+            progress.update(zoom)
+    if min_zoom > 0:
+        print("Stopped at zoom {}, image less than 1 px".format(min_zoom))
 
     # save metadata
-    c.execute("INSERT INTO metadata VALUES ('minzoom', ?)", [min_zoom])
-    c.execute("INSERT INTO metadata VALUES ('maxzoom', ?)", [target_zoom])
-    c.execute("INSERT INTO metadata VALUES ('center', ?)",
-              ["{},{},{}".format(lng, lat, target_zoom - 1)])
-    conn.commit()
-    conn.close()
+    writer.add_metadata("minzoom", min_zoom)
+    writer.add_metadata("maxzoom", target_zoom)
+    writer.add_metadata("center", "{},{},{}".format(lng, lat, target_zoom - 1))
+    if tilesdir is not None:
+        tilesdir.close()
+    writer.close()
+    progress.close()
+
+class InkscapeRenderer(object):
+    """Render areas of a SVG with a long-lived `inkscape --shell` process
+    (command line of Inkscape 0.92).
+
+    This is the default backend of export_lnglat_svg(): any object with the
+    same `size(source)`, `render(source, filename, area, width, height,
+    background)` and `close()` methods can stand in for it.
+    """
+
+    def __init__(self, command="inkscape"):
+        self.process = subprocess.Popen([command, "--shell"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self._read_prompt()
+
+    def _read_prompt(self):
+        """Read the output of the shell up to its prompt, by chunks
+        """
+        fd = self.process.stdout.fileno()
+        output = b""
+        while not (output == b">" or output.endswith(b"\n>")):
+            chunk = read(fd, 4096)
+            if not chunk:
+                raise RuntimeError("Inkscape exited: {}".format(
+                    output.decode(errors="replace")))
+            output += chunk
+        return output[:-1].decode(errors="replace")
+
+    def _run(self, *args):
+        self.process.stdin.write(
+            (" ".join(quote(str(arg)) for arg in args) + "\n").encode())
+        self.process.stdin.flush()
+        return self._read_prompt()
+
+    def size(self, source):
+        w = self._run("-f", source, "-W").split()[-1]
+        h = self._run("-f", source, "-H").split()[-1]
+        return float(w), float(h)
+
+    def render(self, source, filename, area, width, height, background):
+        self._run("-f", source, "-e", filename, "-a",
+                  "{}:{}:{}:{}".format(*area), "-w", width, "-h", height, "-b",
+                  background)
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+class RendererPool(object):
+    """Dispatch the tiles over `workers` renderers created by `renderer`
+    (InkscapeRenderer by default), each one being used by a single thread
+    at a time.
+    """
+
+    def __init__(self, renderer, workers):
+        self.renderers = [renderer() for i in range(max(1, workers))]
+        self.idle = queue.Queue()
+        for instance in self.renderers:
+            self.idle.put(instance)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.renderers))
+
+    def size(self, source):
+        return self.renderers[0].size(source)
+
+    def _render(self, task):
+        instance = self.idle.get()
+        try:
+            instance.render(*task)
+        finally:
+            self.idle.put(instance)
+        return task[1]
+
+    def render(self, tasks):
+        """Render the (source, filename, area, width, height, background)
+        tasks, and yield their filenames in order
+        """
+        return self.executor.map(self._render, tasks)
+
+    def close(self):
+        self.executor.shutdown()
+        for instance in self.renderers:
+            instance.close()
+
 
 def export_lnglat_svg(source,
                       dest,
@@ -370,153 +1832,1047 @@ def export_lnglat_svg(source,
                       minzoom,
                       maxzoom,
                       background_color,
-                      tile_size=256):
+                      tile_size=256,
+                      dedup=False,
+                      resume=False,
+                      encoder=None,
+                      workers=1,
+                      renderer=InkscapeRenderer,
+                      shard=None,
+                      metrics=None,
+                      dry_run=False):
     lng, lat = map(float, center.split(","))
     print("Analyse: {}".format(source))
-    w = float(sh.inkscape("-f", source, "-W"))
-    h = float(sh.inkscape("-f", source, "-H"))
+    pool = RendererPool(renderer, workers)
+    w, h = pool.size(source)
     print("Size: {}x{}".format(w, h))
     print("Center: {},{}".format(lng, lat))
     im_mpx = meterswidth / float(w)
-
-    conn = sqlite3.connect(dest)
-    c = conn.cursor()
-
-    # create database schema
-    c.execute('CREATE TABLE metadata (name text, value text)')
-    c.execute(
-        'CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)'
-    )
-    # indicies aren't necessary but for large databases with many zoom levels
-    # may increase performance
-    c.execute(
-        'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)'
-    )
-    c.execute('CREATE UNIQUE INDEX name ON metadata (name)')
+    plan, levels = plan_svg(w, h, lng, lat, im_mpx, minzoom, maxzoom,
+                            tile_size, shard)
+    if dry_run:
+        # the size of the tiles is not known before rendering them
+        print_plan(plan)
+        pool.close()
+        return
+
+    if encoder is None:
+        encoder = TileEncoder()
+    writer = MBTilesWriter(dest, dedup=dedup, resume=resume)
+    writer.check_encoder(encoder)
+    if tilesdir is not None:
+        tilesdir = TilesDirWriter(tilesdir, encoder.extension)
+    # the renderers write png files, read back into the mbtiles
+    tmpdir = mkdtemp(prefix="image2mbtiles-")
+    if writer.resumed:
+        for zoom in range(minzoom, maxzoom + 1):
+            plan = plan.exclude(zoom, writer.existing_tiles(zoom))
+    progress = Progress(len(plan), metrics)
 
     # fill metadata table with some basic info
-    c.execute("INSERT INTO metadata VALUES ('name', ?)", [dest])
-    c.execute("INSERT INTO metadata VALUES ('type', 'baselayer')")
-    c.execute("INSERT INTO metadata VALUES ('version', '1.0')")
-    c.execute("INSERT INTO metadata VALUES ('description', '')")
-    c.execute("INSERT INTO metadata VALUES ('format', 'png')")
-
-    import subprocess
-    process = subprocess.Popen([
-        "inkscape", "--shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-    while True:
-        ret = process.stdout.read(1)
-        if ret != "\n":
-            continue
-        ret = process.stdout.read(1)
-        if ret != ">":
-            continue
-        break
-
-    for zoom in range(minzoom, maxzoom + 1):
+    writer.add_metadata("name", dest)
+    writer.add_metadata("type", "baselayer")
+    writer.add_metadata("version", "1.0")
+    writer.add_metadata("description", "")
+    writer.add_metadata("format", encoder.format)
+    if shard is not None:
+        writer.add_metadata("shard", "{}/{}".format(*shard))
+
+    for (zoom, target_mpx, zoom_ratio, tw, th, center_x, center_y, x_min,
+         y_min, tile_cols, tile_rows) in levels:
         print("Process zoom {}".format(zoom))
-
-        target_mpx = meters_per_pixel(lat, zoom)
-
         print("  - Target meter per pixels: {}".format(target_mpx))
-        zoom_ratio = im_mpx / target_mpx
-        tw = w * zoom_ratio
-        th = h * zoom_ratio
         print("  - Image size: {}x{}".format(tw, th))
 
         cols = get_col_count(zoom)
         rows = get_row_count(zoom)
         print("  - Maximum number of cols/rows: {}x{}".format(cols, rows))
-        center_x = get_x(zoom, lng, tile_size=tile_size)
-        center_y = get_y(zoom, lat, tile_size=tile_size)
         print("  - Center in pixels is: {}x{}".format(center_x, center_y))
-        x_min = center_x - (tw / 2)
-        y_min = center_y - (th / 2)
         print("  - Minimum x/y: {}x{}".format(x_min, y_min))
-        x_max = x_min + tw
-        y_max = y_min + th
-        print("  - Maximum x/y: {}x{}".format(x_max, y_max))
-        tile_col_min = int(floor(x_min / float(tile_size)))
-        tile_row_min = int(floor(y_min / float(tile_size)))
-        tile_col_max = int(floor(x_max / float(tile_size)))
-        tile_row_max = int(floor(y_max / float(tile_size)))
-        tile_col_count = max(1, tile_col_max - tile_col_min)
-        tile_row_count = max(1, tile_row_max - tile_row_min)
+        print("  - Maximum x/y: {}x{}".format(x_min + tw, y_min + th))
         print("  - Tile range: {}x{} to {}x{}".format(
-            tile_col_min, tile_row_min, tile_col_max, tile_row_max))
-        print("  - Cols count: {}".format(tile_col_count))
-        print("  - Rows count: {}".format(tile_row_count))
-
-        count = (tile_col_count + 1) * (tile_row_count + 1)
-        index = 0
-        for tile_col in range(tile_col_min, tile_col_max + 1):
-            for tile_row in range(tile_row_min, tile_row_max + 1):
-                index += 1
+            tile_cols[0], tile_rows[0], tile_cols[-1], tile_rows[-1]))
+        print("  - Cols count: {}".format(len(tile_cols)))
+        print("  - Rows count: {}".format(len(tile_rows)))
+
+        level = plan.level(zoom)
+        tiles = level.tasks()
+        tasks = []
+        for (tile_col, tile_row), area in zip(tiles, level.window.tolist()):
+            filename = join(tmpdir, "{}-{}-{}.png".format(
+                zoom, tile_col, tile_row))
+            tasks.append((source, filename, tuple(area), tile_size,
+                          tile_size, background_color))
+        for (tile_col, tile_row), filename in zip(tiles, pool.render(tasks)):
+            if VERBOSE:
                 print("  - {}/{}\tcol:{} row:{}".format(
-                    index, count, tile_col, tile_row))
-
-                tile_x = tile_col * tile_size
-                tile_y = tile_row * tile_size
-
-                crop_x = tile_x - x_min
-                crop_y = tile_y - y_min
-                crop_x2 = tile_x + tile_size - x_min
-                crop_y2 = tile_y + tile_size - y_min
-                print("  - Crop {}x{} to {}x{}".format(crop_x, crop_y, crop_x2,
-                                                       crop_y2))
-                filename = join(tilesdir,
-                                str(zoom),
-                                str(tile_col),
-                                "{}.png".format(flip_y(tile_row, zoom)))
-                directory = dirname(filename)
-                if not exists(directory):
-                    makedirs(directory)
-
-                ratio = 1 / zoom_ratio
-                crop_x *= ratio
-                crop_y *= ratio
-                crop_x2 *= ratio
-                crop_y2 *= ratio
-
-                export_area = "{}:{}:{}:{}".format(
-                    crop_x, crop_y, crop_x2, crop_y2)
-
-                cmd = "-f '{}' -e {} -a {} -w {} -h {} -b '{}'\n".format(
-                    source, filename, export_area, tile_size, tile_size, background_color
-                )
-                process.stdin.write(cmd)
-                while True:
-                    ret = process.stdout.read(1)
-                    if ret != "\n":
-                        continue
-                    ret = process.stdout.read(1)
-                    if ret != ">":
-                        continue
-                    break
-                # sh.inkscape("-f", source, "-e", filename, "-a", export_area,
-                #             "-w", tile_size, "-h", tile_size,
-                #             "-b", "#030303")
-
+                    progress.done + 1, progress.total, tile_col, tile_row))
+            if encoder.name == "png" and encoder.compress_level is None:
                 with open(filename, "rb") as fd:
                     data = fd.read()
-
-                c.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)",
-                          [zoom, tile_col, tile_row, data])
-                conn.commit()
+            else:
+                with Image.open(filename) as im:
+                    data = encoder.encode(im)
+            remove(filename)
+            _write_tile(writer, zoom, tile_col, tile_row, data, tilesdir)
+            progress.update(zoom)
 
     # save metadata
-    c.execute("INSERT INTO metadata VALUES ('minzoom', ?)", [minzoom])
-    c.execute("INSERT INTO metadata VALUES ('maxzoom', ?)", [maxzoom])
-    c.execute("INSERT INTO metadata VALUES ('center', ?)",
-              ["{},{},{}".format(lng, lat, maxzoom - 1)])
+    writer.add_metadata("minzoom", minzoom)
+    writer.add_metadata("maxzoom", maxzoom)
+    writer.add_metadata("center", "{},{},{}".format(lng, lat, maxzoom - 1))
+    pool.close()
+    rmtree(tmpdir)
+    if tilesdir is not None:
+        tilesdir.close()
+    writer.close()
+    progress.close()
+
+
+def merge(dest, sources):
+    """Merge mbtiles (the shards of an export) into a new one, with a single
+    metadata table. Report the missing shards, the tiles found in several
+    sources (the first one is kept), and the gaps in the tile ranges.
+    Return the number of errors (unreadable sources, missing shards and
+    overlaps), nothing being merged when a source cannot be read.
+    """
+    print("Merge: {} -> {}".format(", ".join(sources), dest))
+    errors = 0
+    dedup = True
+    metadatas = []
+    for source in sources:
+        # read-only, so a wrong path is not created
+        try:
+            conn = sqlite3.connect(
+                "file:{}?mode=ro".format(abspath(source)), uri=True)
+        except sqlite3.Error as error:
+            print("ERROR: cannot open {}: {}".format(source, error))
+            errors += 1
+            continue
+        try:
+            tables = [
+                name for name, in conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'")
+            ]
+            metadatas.append(
+                dict(conn.execute("SELECT name, value FROM metadata")))
+        except sqlite3.Error as error:
+            print("ERROR: {} is not an mbtiles: {}".format(source, error))
+            errors += 1
+            continue
+        finally:
+            conn.close()
+        dedup = dedup and "map" in tables
+    if errors:
+        return errors
+
+    shards = [metadata.get("shard") for metadata in metadatas]
+    if None not in shards:
+        shards = [tuple(map(int, shard.split("/"))) for shard in shards]
+        count = max(count for index, count in shards)
+        missing = sorted(
+            set(range(1, count + 1)) - set(index for index, _ in shards))
+        if missing or len(set(shards)) != len(shards) or any(
+                shard_count != count for _, shard_count in shards):
+            print("ERROR: expected the shards 1 to {}, got {}".format(
+                count, ", ".join("{}/{}".format(*shard) for shard in shards)))
+            errors += 1
+
+    writer = MBTilesWriter(dest, dedup=dedup)
+    # the unique index drops the overlapping tiles
+    writer._create_indexes()
+    conn = writer.conn
+    table = "map" if dedup else "tiles"
+    for source in sources:
+        print("  - {}".format(source))
+        conn.execute("ATTACH DATABASE ? AS shard", [source])
+        overlaps, = conn.execute(
+            "SELECT COUNT(*) FROM shard.{0} AS s JOIN main.{0} AS t "
+            "ON s.zoom_level = t.zoom_level AND s.tile_column = t.tile_column "
+            "AND s.tile_row = t.tile_row".format(table)).fetchone()
+        if overlaps:
+            print("ERROR: {} tiles of {} are already merged".format(
+                overlaps, source))
+            errors += 1
+        if dedup:
+            conn.execute("INSERT OR IGNORE INTO main.map SELECT zoom_level, "
+                         "tile_column, tile_row, tile_id FROM shard.map")
+            conn.execute("INSERT OR IGNORE INTO main.images SELECT tile_data, "
+                         "tile_id FROM shard.images")
+        else:
+            conn.execute("INSERT OR IGNORE INTO main.tiles SELECT zoom_level, "
+                         "tile_column, tile_row, tile_data FROM shard.tiles")
+        conn.commit()
+        conn.execute("DETACH DATABASE shard")
+
+    for zoom, col_min, col_max, row_min, row_max, count in conn.execute(
+            "SELECT zoom_level, MIN(tile_column), MAX(tile_column), "
+            "MIN(tile_row), MAX(tile_row), COUNT(*) FROM {} "
+            "GROUP BY zoom_level ORDER BY zoom_level".format(table)):
+        gaps = (col_max - col_min + 1) * (row_max - row_min + 1) - count
+        if gaps:
+            print("WARNING: zoom {}: {} tiles missing from {}x{} to {}x{} "
+                  "(expected with --skip-empty)".format(
+                      zoom, gaps, col_min, row_min, col_max, row_max))
+
+    metadata = dict(metadatas[0])
+    metadata.pop("shard", None)
+    metadata["name"] = dest
+    for key, pick in (("minzoom", min), ("maxzoom", max)):
+        values = [int(m[key]) for m in metadatas if key in m]
+        if values:
+            metadata[key] = pick(values)
+    for name, value in metadata.items():
+        writer.add_metadata(name, value)
+    writer.close()
+    return errors
+
+
+def main_merge(argv):
+    parser = argparse.ArgumentParser(
+        prog="image2mbtiles.py merge",
+        description="Merge the shards of an export into one mbtiles")
+    parser.add_argument("mbtiles", help="Merged mbtiles to create")
+    parser.add_argument("shards", nargs="+", help="Shards to merge")
+    args = parser.parse_args(argv)
+    if exists(args.mbtiles):
+        print("ERROR: {} already exists".format(args.mbtiles))
+        sys.exit(1)
+    if merge(args.mbtiles, args.shards):
+        sys.exit(1)
+
+
+def read_manifest(filename):
+    """Read the entries of a batch: a CSV file with a header, or a JSON list of
+    objects. The columns are the options of the command line (image,
+    mbtiles, center, meterswidth, rotation, px, pyramid, minzoom, maxzoom,
+    background), and the paths are relative to the manifest.
+    """
+    with open(filename) as fd:
+        if filename.endswith(".json"):
+            entries = json.load(fd)
+        else:
+            entries = list(csv.DictReader(fd))
+    base = dirname(abspath(filename))
+    for entry in entries:
+        for key in ("image", "mbtiles"):
+            if entry.get(key):
+                entry[key] = normpath(join(base, entry[key]))
+    return entries
+
+
+def _entry_flag(entry, key):
+    return str(entry.get(key, "")).lower() in ("1", "true", "yes")
+
+
+def _export_entry(entry, dest, encoder, dedup, skip_empty, shard=None):
+    def value(key, cast=str, default=None):
+        value = entry.get(key)
+        return cast(value) if value not in (None, "") else default
+
+    source = entry["image"]
+    center = value("center")
+    meterswidth = value("meterswidth", float)
+    if source.endswith(".svg"):
+        if value("minzoom") is None or value("maxzoom") is None:
+            raise ValueError("an SVG source require a minzoom and maxzoom")
+        export_lnglat_svg(
+            source,
+            dest,
+            center=center,
+            meterswidth=meterswidth,
+            tilesdir=None,
+            minzoom=value("minzoom", int),
+            maxzoom=value("maxzoom", int),
+            background_color=value("background", default="#030303"),
+            dedup=dedup,
+            encoder=encoder,
+            shard=shard)
+    elif center or meterswidth:
+        if not center or not meterswidth:
+            raise ValueError("center and meterswidth require each other")
+        export_lnglat(
+            source,
+            dest,
+            center=center,
+            meterswidth=meterswidth,
+            rotation=value("rotation", float, 0.),
+            tilesdir=None,
+            px=_entry_flag(entry, "px"),
+            dedup=dedup,
+            skip_empty=skip_empty,
+            encoder=encoder,
+            shard=shard)
+    else:
+        export(
+            source,
+            dest,
+            tilesdir=None,
+            pyramid=_entry_flag(entry, "pyramid"),
+            dedup=dedup,
+            skip_empty=skip_empty,
+            encoder=encoder,
+            shard=shard)
+
+
+def _run_entry(job):
+    """Export an entry of a batch (or a shard of it), its output being
+    discarded. Return its index, duration and error (None if it succeeded)
+    """
+    index, entry, dest, shard, options = job
+    start = time()
+    try:
+        with open(devnull, "w") as output, redirect_stdout(output):
+            _export_entry(entry, dest, shard=shard, **options)
+    except Exception as error:
+        return index, time() - start, "{}: {}".format(
+            type(error).__name__, error)
+    return index, time() - start, None
+
+
+def _available_memory():
+    """Get the free physical memory in bytes, or None if unknown
+    """
+    try:
+        return sysconf("SC_AVPHYS_PAGES") * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _decoded_bytes(source):
+    """Get the size of a decoded image source (4 bytes per pixel), or 0 if
+    it cannot be read
+    """
+    try:
+        with Image.open(source) as im:
+            w, h = im.size
+    except OSError:
+        return 0
+    return w * h * 4
+
+
+def _merge_entry_shards(dest, shards):
+    """Merge the shards of a batch entry into its mbtiles, and remove them.
+    Return an error message, or None.
+    """
+    try:
+        with open(devnull, "w") as output, redirect_stdout(output):
+            errors = merge(dest, shards)
+    except Exception as error:
+        return "{}: {}".format(type(error).__name__, error)
+    finally:
+        for shard in shards:
+            if exists(shard):
+                remove(shard)
+    if errors:
+        return "{} errors while merging the shards".format(errors)
+    return None
+
+
+def batch(manifest, workers=1, combined=None, encoder=None, dedup=False,
+          skip_empty=False):
+    """Export the entries of a manifest (see read_manifest()) with a single
+    pool of `workers` processes. The entries larger than the share of a
+    process (by file size) are split into shards (see --shard), so their
+    tiles are rendered by several processes, and merged once done. Each
+    shard decodes the whole source, so an entry is only split into as many
+    shards as the free memory can hold at once. The largest jobs are started
+    first, and the small entries fill the other processes meanwhile. With
+    `combined`, the entries are merged into this mbtiles instead of their
+    own, the errors of this merge (such as tiles found in several entries)
+    being reported apart.
+
+    Failed entries are reported, without stopping the others. Return the
+    number of failed entries.
+    """
+    entries = read_manifest(manifest)
+    print("Batch: {} entries, {} workers".format(len(entries), workers))
+    options = dict(encoder=encoder, dedup=dedup, skip_empty=skip_empty)
+    tmpdir = mkdtemp(prefix="image2mbtiles-") if combined else None
+    sizes = [
+        getsize(entry["image"])
+        if entry.get("image") and exists(entry["image"]) else 0
+        for entry in entries
+    ]
+    share = sum(sizes) / float(workers)
+    memory = _available_memory()
+    jobs = []
+    # index: [dest, shard files, number of jobs left, seconds]
+    pending = {}
+    failed = 0
+    for index, entry in enumerate(entries):
+        if combined:
+            dest = join(tmpdir, "{}.mbtiles".format(index))
+        else:
+            dest = entry.get("mbtiles")
+        if not entry.get("image") or not dest:
+            print("ERROR: entry {}: image and mbtiles are required".format(
+                index + 1))
+            failed += 1
+            continue
+        count = 1
+        if workers > 1 and share and not _entry_flag(entry, "pyramid"):
+            count = min(workers, max(1, int(ceil(sizes[index] / share))))
+        if count > 1 and memory is not None and not entry["image"].endswith(
+                ".svg"):
+            # each shard decodes the whole source
+            decoded = _decoded_bytes(entry["image"])
+            if decoded:
+                count = max(1, min(count, memory // decoded))
+        if count > 1:
+            shards = [
+                "{}.shard{}".format(dest, shard)
+                for shard in range(1, count + 1)
+            ]
+            for shard, filename in enumerate(shards, 1):
+                jobs.append((index, entry, filename, (shard, count), options))
+        else:
+            shards = None
+            jobs.append((index, entry, dest, None, options))
+        pending[index] = [dest, shards, count, 0.]
+    jobs.sort(
+        key=lambda job: sizes[job[0]] / (job[3][1] if job[3] else 1),
+        reverse=True)
+
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers)
+        results = pool.imap_unordered(_run_entry, jobs)
+    else:
+        results = map(_run_entry, jobs)
+    errors = {}
+    done = []
+    finished = 0
+    for index, seconds, error in results:
+        if error is not None:
+            errors.setdefault(index, error)
+        state = pending[index]
+        state[2] -= 1
+        state[3] += seconds
+        if state[2]:
+            continue
+        dest, shards, _, seconds = state
+        if shards is not None:
+            if index in errors:
+                for shard in shards:
+                    if exists(shard):
+                        remove(shard)
+            else:
+                error = _merge_entry_shards(dest, shards)
+                if error is not None:
+                    errors[index] = error
+        source = entries[index]["image"]
+        finished += 1
+        if index in errors:
+            print("  - {}/{}\tERROR {}: {}".format(
+                finished, len(pending), source, errors[index]))
+            failed += 1
+        else:
+            done.append(index)
+            print("  - {}/{}\t{} ({:.1f}s)".format(finished, len(pending),
+                                                  source, seconds))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if combined:
+        if done:
+            # tiles shared by several sources are reported, and kept from the
+            # first entry
+            merge_errors = merge(combined, [
+                join(tmpdir, "{}.mbtiles".format(index))
+                for index in sorted(done)
+            ])
+            if merge_errors:
+                print("WARNING: {} errors while merging into {} (see above), "
+                      "the tiles of the first entries are kept".format(
+                          merge_errors, combined))
+        rmtree(tmpdir)
+    print("Batch done: {} entries, {} failed".format(len(entries), failed))
+    return failed
+
+
+def main_batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="image2mbtiles.py batch",
+        description="Convert the images listed in a manifest (CSV or JSON)")
+    parser.add_argument("manifest", help="CSV or JSON manifest")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes (the large images are split between them)")
+    parser.add_argument(
+        "--combined",
+        type=str,
+        help="Merge all the images into this mbtiles")
+    parser.add_argument(
+        "--dedup", action="store_true", help="Store identical tiles once")
+    parser.add_argument(
+        "--skip-empty",
+        action="store_true",
+        help="Do not store the tiles without any visible pixel")
+    _add_encoder_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.combined and exists(args.combined):
+        print("ERROR: {} already exists".format(args.combined))
+        sys.exit(1)
+    failed = batch(
+        args.manifest,
+        workers=args.workers,
+        combined=args.combined,
+        encoder=_encoder_from_args(args),
+        dedup=args.dedup,
+        skip_empty=args.skip_empty)
+    if failed:
+        sys.exit(1)
+
+
+def _optimize_tile(data):
+    """Encode a tile of optimize() again. Return its id and data, or (None,
+    None) if it is empty and empty tiles are dropped.
+    """
+    with _stage("decode"):
+        im = _tile_mode(Image.open(BytesIO(data)))
+    tile_id, encoded = _encode_tile(im)
+    if (encoded is not None and len(encoded) >= len(data)
+            and _tile_format(encoded) == _tile_format(data)):
+        # same format (of each tile, with auto), and no better than the
+        # existing tile
+        encoded = data
+    return tile_id, encoded
+
+
+def optimize(source, dest, workers=1, encoder=None, dedup=False,
+             skip_empty=False, batch_size=4096, metrics=None):
+    """Encode again the tiles of an mbtiles into a new one, with `encoder`,
+    storing identical tiles once (`dedup`) and dropping the empty ones
+    (`skip_empty`). When the format is the same, the smaller version of each
+    tile is kept.
+
+    The tiles are read by batches in rowid order, encoded by a pool of
+    processes, and each batch is committed into `dest`.part along with the
+    last rowid, so an interrupted run resumes from there, provided it has the
+    same encoder, `dedup` and `skip_empty` (ValueError otherwise). The result
+    is analyzed and compacted into `dest` with VACUUM INTO. Report the bytes
+    saved by zoom.
+    """
+    work = dest + ".part"
+    print("Optimize: {} -> {}".format(source, dest))
+    src = sqlite3.connect("file:{}?mode=ro".format(abspath(source)), uri=True)
+    tables = [
+        name for name, in src.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")
+    ]
+    if "map" in tables:
+        table = "map"
+        query = ("SELECT map.rowid, map.zoom_level, map.tile_column, "
+                 "map.tile_row, images.tile_data FROM map "
+                 "JOIN images ON images.tile_id = map.tile_id "
+                 "WHERE map.rowid > ? ORDER BY map.rowid LIMIT ?")
+    else:
+        table = "tiles"
+        query = ("SELECT rowid, zoom_level, tile_column, tile_row, tile_data "
+                 "FROM tiles WHERE rowid > ? ORDER BY rowid LIMIT ?")
+    metadata = dict(src.execute("SELECT name, value FROM metadata"))
+
+    if encoder is None:
+        encoder = TileEncoder()
+    if exists(dest):
+        # interrupted while compacting
+        remove(dest)
+    # committed only with the last rowid, by batch
+    writer = MBTilesWriter(
+        work,
+        batch_size=float("inf"),
+        commit_interval=float("inf"),
+        dedup=dedup,
+        resume=True)
+    last_rowid = 0
+    # zoom: [tiles, bytes before, bytes after, tiles dropped]
+    stats = {}
+    options = json.dumps(
+        {
+            "encoder": encoder.key,
+            "dedup": dedup,
+            "skip_empty": skip_empty
+        },
+        sort_keys=True)
+    if writer.resumed:
+        state = dict(
+            writer.conn.execute(
+                "SELECT name, value FROM metadata WHERE name IN "
+                "('optimize_rowid', 'optimize_stats', 'optimize_options')"))
+        if state.get("optimize_options") != options:
+            writer.conn.close()
+            raise ValueError(
+                "{} was started with other options ({}), remove it to start "
+                "again".format(work, state.get("optimize_options")))
+        last_rowid = int(state.get("optimize_rowid", 0))
+        stats = dict((int(zoom), values) for zoom, values in json.loads(
+            state.get("optimize_stats", "{}")).items())
+        print("Resume after rowid {}".format(last_rowid))
+    else:
+        for name, value in metadata.items():
+            writer.add_metadata(name, value)
+        writer.add_metadata("name", dest)
+        writer.add_metadata("format", encoder.format)
+        writer.add_metadata("encoder", encoder.key)
+        writer.add_metadata("optimize_options", options)
+        # committed before any tile, so a resumed run is always checked
+        writer.flush()
+    remaining, = src.execute(
+        "SELECT COUNT(*) FROM {} WHERE rowid > ?".format(table),
+        [last_rowid]).fetchone()
+    progress = Progress(remaining, metrics)
+
+    _render_state.clear()
+    _render_state["encoder"] = encoder
+    _render_state["dedup"] = writer.dedup
+    _render_state["skip_empty"] = skip_empty
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        while True:
+            rows = src.execute(query, [last_rowid, batch_size]).fetchall()
+            if not rows:
+                break
+            blobs = [row[4] for row in rows]
+            if pool is not None:
+                results = pool.map(_optimize_tile, blobs,
+                                   max(1, len(blobs) // (workers * 4)))
+            else:
+                results = map(_optimize_tile, blobs)
+            for (rowid, zoom, tile_col, tile_row, data), (tile_id, encoded) in \
+                    zip(rows, results):
+                zoom_stats = stats.setdefault(zoom, [0, 0, 0, 0])
+                zoom_stats[0] += 1
+                zoom_stats[1] += len(data)
+                if encoded is None:
+                    zoom_stats[3] += 1
+                else:
+                    if not writer.dedup or tile_id not in writer.tile_ids:
+                        zoom_stats[2] += len(encoded)
+                    _write_tile(writer, zoom, tile_col, tile_row, encoded,
+                                None, tile_id)
+                progress.update(zoom)
+            last_rowid = rows[-1][0]
+            # committed along with the tiles of the batch
+            writer.add_metadata("optimize_rowid", last_rowid)
+            writer.add_metadata("optimize_stats", json.dumps(stats))
+            with _stage("insert"):
+                writer.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    src.close()
+    writer.close()
+    progress.close()
+
+    print("Compact into {}".format(dest))
+    conn = sqlite3.connect(work)
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.execute("VACUUM INTO ?", [dest])
+    conn.close()
+    conn = sqlite3.connect(dest)
+    conn.execute("DELETE FROM metadata WHERE name IN "
+                 "('optimize_rowid', 'optimize_stats', 'optimize_options')")
     conn.commit()
     conn.close()
+    remove(work)
+
+    before = after = 0
+    for zoom in sorted(stats):
+        tiles, zoom_before, zoom_after, dropped = stats[zoom]
+        before += zoom_before
+        after += zoom_after
+        print("  - Zoom {}: {} tiles ({} dropped), {} -> {} bytes, "
+              "{:.1f}% saved".format(
+                  zoom, tiles, dropped, zoom_before, zoom_after,
+                  100. * (zoom_before - zoom_after) / max(1, zoom_before)))
+    print("Tiles: {} -> {} bytes, {:.1f}% saved".format(
+        before, after, 100. * (before - after) / max(1, before)))
+    print("File: {} -> {} bytes".format(
+        stat(source).st_size, stat(dest).st_size))
+
+
+def main_optimize(argv):
+    parser = argparse.ArgumentParser(
+        prog="image2mbtiles.py optimize",
+        description="Encode again and compact the tiles of an mbtiles")
+    parser.add_argument("source", help="Mbtiles to optimize")
+    parser.add_argument("mbtiles", help="Optimized mbtiles to create")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to encode the tiles")
+    parser.add_argument(
+        "--dedup", action="store_true", help="Store identical tiles once")
+    parser.add_argument(
+        "--skip-empty",
+        action="store_true",
+        help="Drop the tiles without any visible pixel")
+    _add_encoder_arguments(parser, compress_default=9)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4096,
+        help="Number of tiles committed at once")
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Append the progress to this file as JSON lines")
+    args = parser.parse_args(argv)
+    if exists(args.mbtiles) and not exists(args.mbtiles + ".part"):
+        print("ERROR: {} already exists".format(args.mbtiles))
+        sys.exit(1)
+    try:
+        optimize(
+            args.source,
+            args.mbtiles,
+            workers=args.workers,
+            encoder=_encoder_from_args(args),
+            dedup=args.dedup,
+            skip_empty=args.skip_empty,
+            batch_size=args.batch_size,
+            metrics=args.metrics_file)
+    except ValueError as error:
+        print("ERROR: {}".format(error))
+        sys.exit(1)
+
+
+class TileCache(object):
+    """Thread-safe LRU cache of tiles, bounded by the size of their data
+    """
 
-    process.terminate()
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+            return item
+
+    def put(self, key, etag, data):
+        if len(data) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = etag, data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, old_data) = self.items.popitem(last=False)
+                self.size -= len(old_data)
+
+
+class MBTilesReader(object):
+    """Read tiles from a mbtiles, with a pool of read-only connections shared
+    by the threads
+    """
+
+    def __init__(self, path, connections=8):
+        self.pool = queue.Queue()
+        for index in range(connections):
+            self.pool.put(
+                sqlite3.connect(
+                    "file:{}?mode=ro".format(abspath(path)),
+                    uri=True,
+                    check_same_thread=False))
+
+    def get_tile(self, zoom, tile_col, tile_row):
+        conn = self.pool.get()
+        try:
+            row = conn.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level = ? "
+                "AND tile_column = ? AND tile_row = ?",
+                [zoom, tile_col, tile_row]).fetchone()
+        finally:
+            self.pool.put(conn)
+        return row[0] if row is not None else None
+
+    def close(self):
+        while not self.pool.empty():
+            self.pool.get().close()
+
+
+class LazyTileReader(object):
+    """Read the tiles of a mbtiles, the missing ones being rendered from the
+    source image like export() does, and stored for the next requests.
+
+    The source stays decoded in memory. Concurrent requests of a tile wait
+    for a single rendering. With `prefetch`, the neighbours and the parent of
+    each rendered tile are rendered in the background.
+    """
+
+    def __init__(self, path, source, tile_size=256, encoder=None,
+                 connections=8, prefetch=False, scratch=None):
+        if scratch is not None:
+            self.im = _open_scratch(source, scratch)
+        else:
+            self.im = Image.open(source)
+            self.im.load()
+            self.im = _tile_mode(self.im)
+        self.tile_size = tile_size
+        w, h = self.im.size
+        self.max_zoom = max(0,
+                            int(ceil(log(max(w, h) / float(tile_size), 2))))
+        if encoder is None:
+            encoder = TileEncoder()
+
+        self.writer = MBTilesWriter(path, resume=True)
+        if not self.writer.resumed:
+            self.writer.add_metadata("name", path)
+            self.writer.add_metadata("type", "baselayer")
+            self.writer.add_metadata("version", "1.0")
+            self.writer.add_metadata("description", "")
+            self.writer.add_metadata("format", encoder.format)
+            self.writer.add_metadata("encoder", encoder.key)
+            self.writer.add_metadata("minzoom", 0)
+            self.writer.add_metadata("maxzoom", self.max_zoom)
+            self.writer.add_metadata("projection", "xy")
+            self.writer._create_indexes()
+        self.reader = MBTilesReader(path, connections)
+        self.lock = threading.Lock()
+        self.rendering = {}
+        self.prefetcher = None
+        if prefetch:
+            self.prefetcher = ThreadPoolExecutor(max_workers=2)
+
+        # tiles are identified by the writer when deduplicating
+        _render_state.clear()
+        _render_state["encoder"] = encoder
+
+    def get_tile(self, zoom, tile_col, tile_row):
+        data = self.reader.get_tile(zoom, tile_col, tile_row)
+        if data is None:
+            data = self._render(zoom, tile_col, tile_row)
+            if data is not None and self.prefetcher is not None:
+                for col, row in ((tile_col - 1, tile_row),
+                                 (tile_col + 1, tile_row),
+                                 (tile_col, tile_row - 1),
+                                 (tile_col, tile_row + 1)):
+                    self.prefetcher.submit(self._prefetch, zoom, col, row)
+                self.prefetcher.submit(self._prefetch, zoom - 1,
+                                       tile_col // 2, tile_row // 2)
+        return data
+
+    def _prefetch(self, zoom, tile_col, tile_row):
+        if self.reader.get_tile(zoom, tile_col, tile_row) is None:
+            self._render(zoom, tile_col, tile_row)
+
+    def _render(self, zoom, tile_col, tile_row):
+        """Render and store a tile, or wait for the thread rendering it.
+        Return None if the tile is outside of the image.
+        """
+        w, h = self.im.size
+        level = self.max_zoom - zoom
+        if zoom < 0 or level < 0:
+            return None
+        cols, rows = _level_grid(w, h, self.max_zoom, level, self.tile_size)
+        if not (0 <= tile_col < cols and 0 <= tile_row < rows):
+            return None
+
+        key = (zoom, tile_col, tile_row)
+        with self.lock:
+            future = self.rendering.get(key)
+            if future is not None:
+                wait = True
+            else:
+                wait = False
+                future = self.rendering[key] = Future()
+        if wait:
+            return future.result()
+        try:
+            # it may have been stored since the first read
+            data = self.reader.get_tile(*key)
+            if data is None:
+                im = _crop_tile(self.im, level, tile_col, tile_row,
+                                self.tile_size)
+                _, data = _encode_tile(im)
+                with self.lock:
+                    self.writer.add_tile(zoom, tile_col, tile_row, data)
+                    self.writer.flush()
+            future.set_result(data)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.rendering[key]
+        return data
+
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+        self.reader.close()
+        with self.lock:
+            self.writer.close()
+
+
+def _tile_content_type(data):
+    fmt = _tile_format(data)
+    return "image/jpeg" if fmt == "jpg" else "image/{}".format(fmt)
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Serve the tiles of the server mbtiles as /{z}/{x}/{y}.png (XYZ rows)
+    """
+    protocol_version = "HTTP/1.1"
+    path_re = re.compile(r"^/(\d+)/(\d+)/(\d+)\.(png|jpg|jpeg|webp)$")
+
+    def do_GET(self):
+        match = self.path_re.match(self.path.split("?")[0])
+        if match is None:
+            self.send_error(404)
+            return
+        zoom, x, y = map(int, match.groups()[:3])
+        key = (zoom, x, flip_y(y, zoom))
+        item = self.server.cache.get(key)
+        if item is None:
+            data = self.server.reader.get_tile(*key)
+            if data is None:
+                self.send_error(404)
+                return
+            item = '"{}"'.format(hashlib.md5(data).hexdigest()), data
+            self.server.cache.put(key, *item)
+        etag, data = item
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", _tile_content_type(data))
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("ETag", etag)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(path,
+          host="127.0.0.1",
+          port=8000,
+          cache_size=64 * 1024 * 1024,
+          connections=8,
+          source=None,
+          tile_size=256,
+          encoder=None,
+          prefetch=False,
+          scratch=None):
+    """Serve the tiles of a mbtiles over HTTP, until interrupted. With a
+    source image, the missing tiles are rendered on demand (see
+    LazyTileReader).
+    """
+    server = ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.daemon_threads = True
+    if source is not None:
+        print("Source: {}".format(source))
+        server.reader = LazyTileReader(
+            path,
+            source,
+            tile_size=tile_size,
+            encoder=encoder,
+            connections=connections,
+            prefetch=prefetch,
+            scratch=scratch)
+    else:
+        server.reader = MBTilesReader(path, connections)
+    server.cache = TileCache(cache_size)
+    print("Serve {} on http://{}:{}/{{z}}/{{x}}/{{y}}.png".format(
+        path, host, server.server_address[1]), flush=True)
+    # close the mbtiles properly when killed as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.reader.close()
+
+
+def main_serve(argv):
+    parser = argparse.ArgumentParser(
+        prog="image2mbtiles.py serve",
+        description="Serve the tiles of a mbtiles over HTTP")
+    parser.add_argument("mbtiles", help="Mbtiles to serve")
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="Size of the cache of tiles, in MB")
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=8,
+        help="Number of connections to the mbtiles")
+    parser.add_argument(
+        "--source",
+        type=str,
+        help=
+        "Render the missing tiles from this image on demand, and store them in the mbtiles"
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help=
+        "Render the neighbours and the parent of the rendered tiles in the background (with --source)"
+    )
+    parser.add_argument(
+        "--scratch",
+        type=str,
+        help="Map the decoded source from this file (with --source)")
+    _add_encoder_arguments(parser)
+    args = parser.parse_args(argv)
+    if not args.source and not exists(args.mbtiles):
+        print("ERROR: {} doesn't exist".format(args.mbtiles))
+        sys.exit(1)
+    serve(
+        args.mbtiles,
+        host=args.host,
+        port=args.port,
+        cache_size=args.cache_size * 1024 * 1024,
+        connections=args.connections,
+        source=args.source,
+        encoder=_encoder_from_args(args),
+        prefetch=args.prefetch,
+        scratch=args.scratch)
 
 
 def main():
-    parser = argparse.ArgumentParser(description="Convert image to mbtiles")
+    commands = {
+        "batch": main_batch,
+        "merge": main_merge,
+        "optimize": main_optimize,
+        "serve": main_serve,
+    }
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](sys.argv[2:])
+        return
+
+    parser = argparse.ArgumentParser(
+        description="Convert image to mbtiles",
+        epilog=
+        "Other commands: '%(prog)s merge output.mbtiles shard.mbtiles...' "
+        "merges shards, '%(prog)s serve output.mbtiles' serves the tiles over "
+        "HTTP, '%(prog)s batch manifest.csv' converts the images of a "
+        "manifest, '%(prog)s optimize input.mbtiles output.mbtiles' encodes "
+        "again and compacts the tiles")
     parser.add_argument(
         "--center",
         default=None,
@@ -536,48 +2892,184 @@ def main():
         help=
         "After finding the zoom level, don't resize the initial image (pixel perfect mode)"
     )
+    parser.add_argument(
+        "--pyramid",
+        action="store_true",
+        help=
+        "Build each zoom level from the tiles of the level below instead of the source image"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help=
+        "Read the source image by bands instead of loading it in memory (uncompressed TIFF only, implies --pyramid)"
+    )
+    parser.add_argument(
+        "--scratch",
+        type=str,
+        help=
+        "Decode the source once into this uncompressed file, mapped in memory and reused by the next runs"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Complete an existing mbtiles, generating only the missing tiles")
+    parser.add_argument(
+        "--update-region",
+        type=str,
+        help=
+        "Generate again the tiles covering a region of the image (x,y,w,h format, in pixels) in an existing mbtiles"
+    )
+    parser.add_argument(
+        "--shard",
+        type=str,
+        help=
+        "Generate only the part i of N of the tiles (i/N format, from 1/N to N/N), to merge later"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=
+        "Print the number of tiles and of source pixels read by zoom, and the estimated size, without generating them"
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Print each tile, instead of the progress every few seconds")
+    parser.add_argument(
+        "--stage-timers",
+        action="store_true",
+        help="Measure the time spent cropping, resizing, encoding and inserting the tiles")
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="Append the progress (and stage timers) to this file as JSON lines")
+    _add_encoder_arguments(parser)
     parser.add_argument(
         "--minzoom", type=int, help="Minimum zoom to generate (svg only)")
     parser.add_argument(
         "--maxzoom", type=int, help="Maximum zoom to generate (svg only)")
     parser.add_argument(
         "--background", type=str, default="#030303", help="Background color of the map (svg only)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to render the tiles")
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="Store identical tiles only once (map/images schema)")
+    parser.add_argument(
+        "--skip-empty",
+        action="store_true",
+        help="Don't store the tiles without any visible pixel of the image")
     parser.add_argument("image", help="Source image")
     parser.add_argument("mbtiles", help="Destination mbtiles")
     args = parser.parse_args()
-
-    if args.image.endswith(".svg"):
-        if not args.maxzoom or not args.minzoom:
-            print("ERROR: an SVG source require a minzoom and maxzoom")
+    encoder = _encoder_from_args(args)
+    global VERBOSE, STAGE_TIMERS
+    VERBOSE = args.verbose
+    STAGE_TIMERS = args.stage_timers
+
+    update_region = None
+    if args.update_region:
+        if args.image.endswith(".svg") or args.center or args.meterswidth:
+            print("ERROR: update-region is only available for the images "
+                  "without center and meterswidth")
             sys.exit(1)
-        export_lnglat_svg(
-            args.image,
-            args.mbtiles,
-            center=args.center,
-            meterswidth=args.meterswidth,
-            tilesdir=args.tilesdir,
-            minzoom=args.minzoom,
-            maxzoom=args.maxzoom,
-            background_color=args.background)
-
-    elif (args.center or args.meterswidth):
-        if not args.center:
-            print("ERROR: meterswidth require center option too")
+        if not exists(args.mbtiles):
+            print("ERROR: update-region requires an existing mbtiles")
             sys.exit(1)
-        if not args.meterswidth:
-            print("ERROR: center option requires meterswidth option too")
+        try:
+            update_region = list(map(int, args.update_region.split(",")))
+        except ValueError:
+            update_region = None
+        if update_region is None or len(update_region) != 4:
+            print("ERROR: update-region must be x,y,w,h, in pixels")
+            sys.exit(1)
+
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(map(int, args.shard.split("/")))
+        except ValueError:
+            shard = ()
+        if len(shard) != 2 or not 1 <= shard[0] <= shard[1]:
+            print("ERROR: shard must be i/N, with i from 1 to N")
+            sys.exit(1)
+        if args.pyramid or args.stream:
+            print("ERROR: shard can't be used with pyramid or stream")
             sys.exit(1)
-        export_lnglat(
-            args.image,
-            args.mbtiles,
-            center=args.center,
-            meterswidth=args.meterswidth,
-            rotation=args.rotation,
-            tilesdir=args.tilesdir,
-            px=args.px)
-    else:
-        export(args.image, args.mbtiles, tilesdir=args.tilesdir)
 
+    try:
+        if args.image.endswith(".svg"):
+            if not args.maxzoom or not args.minzoom:
+                print("ERROR: an SVG source require a minzoom and maxzoom")
+                sys.exit(1)
+            export_lnglat_svg(
+                args.image,
+                args.mbtiles,
+                center=args.center,
+                meterswidth=args.meterswidth,
+                tilesdir=args.tilesdir,
+                minzoom=args.minzoom,
+                maxzoom=args.maxzoom,
+                background_color=args.background,
+                dedup=args.dedup,
+                resume=args.resume,
+                encoder=encoder,
+                workers=args.workers,
+                shard=shard,
+                metrics=args.metrics_file,
+                dry_run=args.dry_run)
+
+        elif (args.center or args.meterswidth):
+            if not args.center:
+                print("ERROR: meterswidth require center option too")
+                sys.exit(1)
+            if not args.meterswidth:
+                print("ERROR: center option requires meterswidth option too")
+                sys.exit(1)
+            export_lnglat(
+                args.image,
+                args.mbtiles,
+                center=args.center,
+                meterswidth=args.meterswidth,
+                rotation=args.rotation,
+                tilesdir=args.tilesdir,
+                px=args.px,
+                workers=args.workers,
+                dedup=args.dedup,
+                skip_empty=args.skip_empty,
+                scratch=args.scratch,
+                resume=args.resume,
+                encoder=encoder,
+                shard=shard,
+                metrics=args.metrics_file,
+                dry_run=args.dry_run)
+        else:
+            export(
+                args.image,
+                args.mbtiles,
+                tilesdir=args.tilesdir,
+                pyramid=args.pyramid,
+                workers=args.workers,
+                dedup=args.dedup,
+                skip_empty=args.skip_empty,
+                stream=args.stream,
+                scratch=args.scratch,
+                resume=args.resume,
+                update_region=update_region,
+                encoder=encoder,
+                shard=shard,
+                metrics=args.metrics_file,
+                dry_run=args.dry_run)
+
+    except ValueError as error:
+        # e.g. an mbtiles resumed with other encoder settings
+        print("ERROR: {}".format(error))
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()